@@ -0,0 +1,225 @@
+import os, sys, mmap, fcntl, struct, hashlib, threading, time, gzip
+from cachetools import LRUCache
+
+# brotli is optional, when it's not installed responses are only compressed with gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# the content encodings responses can be cached in, in the order they are preferred when a client accepts several
+CONTENT_ENCODINGS = ["br", "gzip", "identity"] if brotli is not None else ["gzip", "identity"]
+
+
+# encode a response body in each of the CONTENT_ENCODINGS, as each response is encoded once & then served from the cache
+# for as long as it doesn't change the highest compression levels are used
+def encode_content(body):
+    encoded_bodies = {"gzip": gzip.compress(body, compresslevel=9), "identity": body}
+    if brotli is not None:
+        encoded_bodies["br"] = brotli.compress(body)
+    return encoded_bodies
+
+
+# a cache of bytes values kept in the memory of the current process, each value can have its own time to live (in
+# seconds) or be kept until it's evicted to make room for newer values if its ttl is None
+class MemoryCache:
+
+    def __init__(self, max_size=1024):
+        self.cache = LRUCache(maxsize=max_size)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            cached_value = self.cache.get(key)
+            if cached_value is None:
+                return None
+            expires_at, value = cached_value
+            if expires_at is not None and expires_at <= time.time():
+                del self.cache[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = None if ttl is None else time.time() + ttl
+        with self.lock:
+            self.cache[key] = (expires_at, value)
+
+    def delete(self, key):
+        with self.lock:
+            self.cache.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    # returns the cache counters
+    def get_stats(self):
+        with self.lock:
+            stats = {
+                "max_size": self.cache.maxsize,
+                "size": self.cache.currsize
+            }
+        return stats
+
+
+# a cache of bytes values kept in a memory mapped file (by default under /dev/shm) which is shared by all the processes
+# on the host that open it so every gunicorn worker sees the same values & a delete done by one of them is seen by all,
+# the file is split into fixed size slots & each key can be in one of a few slots picked by its hash, values that don't
+# fit in a slot are kept in an overflow MemoryCache of up to overflow_max_size values in the memory of the current
+# process instead (or not cached at all if it's 0), as the overflow isn't shared a delete done by another process isn't
+# seen by it so it should only be used for values that never change under the same key
+class SharedMemoryCache:
+
+    # the file starts with a header of the magic, the slot size & the slot count, each slot then starts with a header of
+    # the key hash, the time the value expires at (0 if it doesn't), the key length & the value length
+    FILE_HEADER = struct.Struct("<8sII")
+    FILE_MAGIC = b"NBLCACHE"
+    SLOT_HEADER = struct.Struct("<8sdII")
+    SLOT_WAYS = 4
+
+    def __init__(self, path, size, slot_size=65536, overflow_max_size=0):
+        self.path = path
+        self.slot_size = slot_size
+        self.overflow_cache = MemoryCache(max_size=overflow_max_size) if overflow_max_size > 0 else None
+        self.oversized_values = 0
+        self.slot_count = max(1, (size - self.FILE_HEADER.size) // slot_size)
+        self.size = self.FILE_HEADER.size + self.slot_count * slot_size
+        self.lock = threading.Lock()
+        self.file_descriptor = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self.file_descriptor, fcntl.LOCK_EX)
+        try:
+            file_header = self.FILE_HEADER.pack(self.FILE_MAGIC, self.slot_size, self.slot_count)
+            if os.fstat(self.file_descriptor).st_size != self.size or \
+                    os.pread(self.file_descriptor, self.FILE_HEADER.size, 0) != file_header:
+                os.ftruncate(self.file_descriptor, 0)
+                os.ftruncate(self.file_descriptor, self.size)
+                os.pwrite(self.file_descriptor, file_header, 0)
+            self.memory = mmap.mmap(self.file_descriptor, self.size)
+        finally:
+            fcntl.flock(self.file_descriptor, fcntl.LOCK_UN)
+
+    # returns the hash of a key & the offsets of the slots it can be in
+    def key_slots(self, key):
+        key_hash = hashlib.blake2b(key, digest_size=8).digest()
+        first_slot = int.from_bytes(key_hash, "little") % self.slot_count
+        slot_offsets = []
+        for way in range(min(self.SLOT_WAYS, self.slot_count)):
+            slot_offsets.append(self.FILE_HEADER.size + ((first_slot + way) % self.slot_count) * self.slot_size)
+        return key_hash, slot_offsets
+
+    # returns the offset of the slot holding a key or None if it's not cached, must be called while holding the locks
+    def find_slot(self, key, key_hash, slot_offsets):
+        for slot_offset in slot_offsets:
+            slot_key_hash, expires_at, key_length, value_length = self.SLOT_HEADER.unpack_from(self.memory, slot_offset)
+            if slot_key_hash == key_hash and key_length == len(key):
+                key_offset = slot_offset + self.SLOT_HEADER.size
+                if self.memory[key_offset:key_offset + key_length] == key:
+                    return slot_offset
+        return None
+
+    def get(self, key):
+        if self.overflow_cache is not None:
+            value = self.overflow_cache.get(key)
+            if value is not None:
+                return value
+        key = key.encode('utf-8')
+        key_hash, slot_offsets = self.key_slots(key)
+        with self.lock:
+            fcntl.flock(self.file_descriptor, fcntl.LOCK_SH)
+            try:
+                slot_offset = self.find_slot(key, key_hash, slot_offsets)
+                if slot_offset is None:
+                    return None
+                slot_key_hash, expires_at, key_length, value_length = self.SLOT_HEADER.unpack_from(self.memory,
+                                                                                                   slot_offset)
+                if expires_at != 0 and expires_at <= time.time():
+                    return None
+                value_offset = slot_offset + self.SLOT_HEADER.size + key_length
+                return self.memory[value_offset:value_offset + value_length]
+            finally:
+                fcntl.flock(self.file_descriptor, fcntl.LOCK_UN)
+
+    # cache a value, it replaces the same key if it's already cached or else an empty or expired slot or else the slot
+    # that expires first, values too large for a slot are counted & kept in the overflow cache (if there is one),
+    # returns False if the value wasn't cached
+    def set(self, key, value, ttl=None):
+        encoded_key = key.encode('utf-8')
+        if self.SLOT_HEADER.size + len(encoded_key) + len(value) > self.slot_size:
+            with self.lock:
+                self.oversized_values += 1
+                first_oversized_value = self.oversized_values == 1
+            if first_oversized_value is True:
+                print("a value of " + str(len(value)) + " bytes is too large for the " + str(self.slot_size) +
+                      " bytes slots of the shared memory cache at " + self.path + " - consider raising its slot size",
+                      file=sys.stderr)
+            if self.overflow_cache is None:
+                return False
+            self.overflow_cache.set(key, value, ttl=ttl)
+            return True
+        if self.overflow_cache is not None:
+            self.overflow_cache.delete(key)
+        key = encoded_key
+        expires_at = 0 if ttl is None else time.time() + ttl
+        key_hash, slot_offsets = self.key_slots(key)
+        with self.lock:
+            fcntl.flock(self.file_descriptor, fcntl.LOCK_EX)
+            try:
+                slot_offset = self.find_slot(key, key_hash, slot_offsets)
+                if slot_offset is None:
+                    slot_offset = self.pick_replaced_slot(slot_offsets)
+                self.SLOT_HEADER.pack_into(self.memory, slot_offset, key_hash, expires_at, len(key), len(value))
+                key_offset = slot_offset + self.SLOT_HEADER.size
+                self.memory[key_offset:key_offset + len(key) + len(value)] = key + value
+            finally:
+                fcntl.flock(self.file_descriptor, fcntl.LOCK_UN)
+        return True
+
+    # returns the offset of the slot a new key should replace, must be called while holding the locks
+    def pick_replaced_slot(self, slot_offsets):
+        replaced_slot_offset = slot_offsets[0]
+        replaced_expires_at = None
+        for slot_offset in slot_offsets:
+            slot_key_hash, expires_at, key_length, value_length = self.SLOT_HEADER.unpack_from(self.memory, slot_offset)
+            if key_length == 0 or (expires_at != 0 and expires_at <= time.time()):
+                return slot_offset
+            if expires_at != 0 and (replaced_expires_at is None or expires_at < replaced_expires_at):
+                replaced_slot_offset = slot_offset
+                replaced_expires_at = expires_at
+        return replaced_slot_offset
+
+    def delete(self, key):
+        if self.overflow_cache is not None:
+            self.overflow_cache.delete(key)
+        key = key.encode('utf-8')
+        key_hash, slot_offsets = self.key_slots(key)
+        with self.lock:
+            fcntl.flock(self.file_descriptor, fcntl.LOCK_EX)
+            try:
+                slot_offset = self.find_slot(key, key_hash, slot_offsets)
+                if slot_offset is not None:
+                    self.SLOT_HEADER.pack_into(self.memory, slot_offset, b"\0" * 8, 0, 0, 0)
+            finally:
+                fcntl.flock(self.file_descriptor, fcntl.LOCK_UN)
+
+    def clear(self):
+        if self.overflow_cache is not None:
+            self.overflow_cache.clear()
+        with self.lock:
+            fcntl.flock(self.file_descriptor, fcntl.LOCK_EX)
+            try:
+                for slot in range(self.slot_count):
+                    self.SLOT_HEADER.pack_into(self.memory, self.FILE_HEADER.size + slot * self.slot_size, b"\0" * 8,
+                                               0, 0, 0)
+            finally:
+                fcntl.flock(self.file_descriptor, fcntl.LOCK_UN)
+
+    # returns the cache counters, the overflow ones are of the current process only
+    def get_stats(self):
+        with self.lock:
+            stats = {
+                "slot_size": self.slot_size,
+                "slot_count": self.slot_count,
+                "oversized_values": self.oversized_values,
+                "overflow": self.overflow_cache.get_stats() if self.overflow_cache is not None else None
+            }
+        return stats
@@ -1,33 +1,141 @@
-import sys, os
-from pymongo import MongoClient, ReturnDocument, ASCENDING
+import sys, os, threading, json, re, time, hashlib, datetime
+from pymongo import MongoClient, ReturnDocument, ASCENDING, DESCENDING, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
 from bson.objectid import ObjectId
+from bson.json_util import dumps
+from cachetools import TTLCache
+from functions.rollouts.rollouts import get_rollout_finish_time, apply_held_back_apps
 
 
 class MongoConnection:
 
     # connect to db
-    def __init__(self, mongo_connection_string, schema_name="nebula", max_pool_size=100):
+    def __init__(self, mongo_connection_string, schema_name="nebula", max_pool_size=100,
+                 permissions_cache_max_size=1024, permissions_cache_time=10, references_cache_max_size=1024,
+                 references_cache_time=10):
+        # the compiled permissions of each user are kept in memory, the generation is increased every time they are
+        # invalidated so that permissions compiled before a user_group changed are not cached after it
+        self.user_permissions_cache = TTLCache(maxsize=permissions_cache_max_size, ttl=permissions_cache_time)
+        self.user_permissions_generation = 0
+        self.user_permissions_lock = threading.Lock()
+        # the permissions version is kept in memory for as long as the compiled permissions are, the compiled
+        # permissions are dropped whenever it's seen changing as that means a user or a user_group was changed by
+        # another process
+        self.permissions_version_cache = TTLCache(maxsize=1, ttl=permissions_cache_time)
+        self.user_permissions_version = None
+        # the device groups that use each app & cron job are kept in memory, the generation is increased every time they
+        # are invalidated so that device groups listed before a device group changed are not cached after it
+        self.device_group_references_cache = TTLCache(maxsize=references_cache_max_size, ttl=references_cache_time)
+        self.device_group_references_generation = 0
+        self.device_group_references_lock = threading.Lock()
+        # functions called with the name of a device group each time its materialized config is rebuilt by this process
+        self.device_group_config_listeners = []
+        # functions called each time this process changes the rollout of an app
+        self.app_rollouts_listeners = []
+        # the rebuilds of stale materialized configs running in this process by their device group, each holds the lock
+        # only one rebuild of the device group runs under & how many reads are using it
+        self.device_group_config_rebuilds = {}
+        self.device_group_config_rebuilds_lock = threading.Lock()
+        # the names of the REPORTS_INDEXES that exist with the expected keys, read from the db on first use
+        self.reports_index_names = None
         try:
             self.client = MongoClient(mongo_connection_string, maxPoolSize=max_pool_size)
             self.db = self.client[schema_name]
             self.collection = {"apps": self.db["nebula_apps"], "device_groups": self.db["nebula_device_groups"],
                                "reports": self.db["nebula_reports"], "users": self.db["nebula_users"],
-                               "user_groups": self.db["nebula_user_groups"], "cron_jobs": self.db["nebula_cron_jobs"]}
+                               "user_groups": self.db["nebula_user_groups"], "cron_jobs": self.db["nebula_cron_jobs"],
+                               "settings": self.db["nebula_settings"],
+                               "device_group_configs": self.db["nebula_device_group_configs"],
+                               "app_rollouts": self.db["nebula_app_rollouts"],
+                               "reports_latest": self.db["nebula_reports_latest"]}
         except Exception as e:
             print("error connection to mongodb")
             print(e, file=sys.stderr)
             os._exit(2)
 
     # create indexes
-    def mongo_create_index(self, collection_name, collection_index):
+    def mongo_create_index(self, collection_name, collection_index, unique=True):
         try:
             self.collection[collection_name].create_index([(collection_index, ASCENDING)], background=True,
-                                                          name=collection_index + "_index", unique=True, sparse=True)
+                                                          name=collection_index + "_index", unique=unique, sparse=True)
         except Exception as e:
             print("error creating mongodb indexes")
             print(e, file=sys.stderr)
             os._exit(2)
 
+    # create the index used to find a user by the token_id of his token, users with a legacy token don't have a token_id
+    # so they are left out of it
+    def mongo_create_token_id_index(self):
+        try:
+            self.collection["users"].create_index([("token_id", ASCENDING)], background=True, name="token_id_index",
+                                                  unique=True,
+                                                  partialFilterExpression={"token_id": {"$type": "string"}})
+        except Exception as e:
+            print("error creating mongodb indexes")
+            print(e, file=sys.stderr)
+            os._exit(2)
+
+    # create the compound indexes the reports filters are served from, each is named after the filter shape it serves &
+    # report queries are hinted to use them, as they are only needed for performance an index that can't be created
+    # (like when the same keys are already indexed under another name) is logged & the queries it serves aren't hinted
+    def mongo_create_reports_indexes(self):
+        try:
+            for index_name, index_keys in REPORTS_INDEXES.items():
+                try:
+                    self.collection["reports"].create_index(index_keys, background=True, name=index_name)
+                except OperationFailure as e:
+                    print("unable to create the reports index " + index_name + " - queries it serves won't be hinted",
+                          file=sys.stderr)
+                    print(e, file=sys.stderr)
+            try:
+                self.collection["reports_latest"].create_index([("device_group", ASCENDING), ("_id", ASCENDING)],
+                                                               background=True,
+                                                               name="reports_latest_device_group_index")
+            except OperationFailure as e:
+                print("unable to create the latest reports index", file=sys.stderr)
+                print(e, file=sys.stderr)
+            self.reports_index_names = None
+            self.mongo_list_reports_index_names()
+        except Exception as e:
+            print("error creating mongodb indexes")
+            print(e, file=sys.stderr)
+            os._exit(2)
+
+    # list the names of the REPORTS_INDEXES that exist with the expected keys, they are read from the db once
+    def mongo_list_reports_index_names(self):
+        if self.reports_index_names is None:
+            reports_indexes = self.collection["reports"].index_information()
+            self.reports_index_names = {index_name for index_name, index_keys in REPORTS_INDEXES.items()
+                                        if index_name in reports_indexes and
+                                        reports_indexes[index_name]["key"] == index_keys}
+        return self.reports_index_names
+
+    # stream the documents of a collection sorted by name, limit sets how many documents to list (0 for all of them) &
+    # after is the name to list after (the last name of the previous page) so paging doesn't need skipping over the
+    # documents already listed, names limits the documents to the ones with those names & fields limits each document
+    # to those fields (along with its name)
+    def mongo_iterate_documents(self, collection_name, name_field, limit=0, after=None, names=None, fields=None):
+        query = {name_field: {"$exists": True}}
+        if after is not None:
+            query[name_field]["$gt"] = after
+        if names is not None:
+            query[name_field]["$in"] = names
+        projection = {'_id': False}
+        if fields is not None:
+            projection[name_field] = True
+            for field in fields:
+                if field != "_id":
+                    projection[field] = True
+        cursor = self.collection[collection_name].find(query, projection)
+        for result in cursor.sort(name_field, ASCENDING).limit(limit):
+            yield result
+
+    # stream the names of a collection documents sorted by name in the same pages as mongo_iterate_documents, only the
+    # name_field is read so the listing is served from its unique index
+    def mongo_iterate_names(self, collection_name, name_field, limit=0, after=None):
+        for result in self.mongo_iterate_documents(collection_name, name_field, limit=limit, after=after, fields=[]):
+            yield result[name_field]
+
     # get all app data
     def mongo_get_app(self, app_name):
         result = self.collection["apps"].find_one({"app_name": app_name}, {'_id': False})
@@ -66,6 +174,7 @@ class MongoConnection:
                                                               },
                                                              upsert=True,
                                                              return_document=ReturnDocument.AFTER)
+        self.mongo_mark_app_device_group_configs_stale([app_name])
         return result
 
     # get latest envvars of app
@@ -79,6 +188,7 @@ class MongoConnection:
                                                              {'$inc': {'app_id': 1},
                                                               '$set': {'env_vars': env_vars}},
                                                              return_document=ReturnDocument.AFTER)
+        self.mongo_mark_app_device_group_configs_stale([app_name])
         return result
 
     # update some fields of an app
@@ -87,6 +197,7 @@ class MongoConnection:
                                                              {'$inc': {'app_id': 1},
                                                               '$set': update_fields_dict},
                                                              return_document=ReturnDocument.AFTER)
+        self.mongo_mark_app_device_group_configs_stale([app_name])
         return result
 
     # get number of containers per cpu of app
@@ -100,48 +211,204 @@ class MongoConnection:
                                                              {'$inc': {'app_id': 1},
                                                               '$set': {'containers_per': containers_per}},
                                                              return_document=ReturnDocument.AFTER)
+        self.mongo_mark_app_device_group_configs_stale([app_name])
         return result
 
     # get list of apps
-    def mongo_list_apps(self):
-        apps_list = []
-        for app in self.collection["apps"].find({"app_name": {"$exists": "true"}}, {'_id': False}):
-            apps_list.append(app["app_name"])
-        return apps_list
+    def mongo_list_apps(self, limit=0, after=None):
+        return list(self.mongo_iterate_names("apps", "app_name", limit=limit, after=after))
+
+    # get all the data of a list of apps with a single query, apps that don't exist are left out & the rest are returned
+    # in the order they were asked for
+    def mongo_list_apps_by_name(self, app_names):
+        apps = {}
+        for app in self.collection["apps"].find({"app_name": {"$in": app_names}}, {'_id': False}):
+            apps[app["app_name"]] = app
+        return [apps[app_name] for app_name in app_names if app_name in apps]
+
+    # list the names out of the given ones that no document of a collection has in its name_field, only the names are
+    # read so checking many apps or cron jobs exist is a single light query, anything given that isn't a name (string)
+    # is always listed as missing
+    def mongo_list_missing_names(self, collection_name, name_field, names):
+        existing_names = set()
+        checked_names = [name for name in names if type(name) is str]
+        for result in self.collection[collection_name].find({name_field: {"$in": checked_names}},
+                                                            {'_id': False, name_field: True}):
+            existing_names.add(result[name_field])
+        return [name for name in names if type(name) is not str or name not in existing_names]
+
+    # list the apps out of the given ones that don't exist
+    def mongo_list_missing_apps(self, app_names):
+        return self.mongo_list_missing_names("apps", "app_name", app_names)
 
     # add app
     def mongo_add_app(self, app_name, starting_ports, containers_per, env_vars, docker_image, running=True,
                       networks=None, volumes=None, devices=None, privileged=False, rolling_restart=False):
-        # creating the list inside the function to avoid mutable value list in the function default value
-        if volumes is None:
-            volumes = []
-        if devices is None:
-            devices = []
-        if networks is None:
-            networks = ["nebula"]
-        app_doc = {
-            "app_id": 1,
-            "app_name": app_name,
-            "starting_ports": starting_ports,
-            "containers_per": containers_per,
-            "env_vars": env_vars,
-            "docker_image": docker_image,
-            "running": running,
-            "networks": networks,
-            "volumes": volumes,
-            "devices": devices,
-            "privileged": privileged,
-            "rolling_restart": rolling_restart
-        }
+        app_doc = get_app_doc(app_name, starting_ports, containers_per, env_vars, docker_image, running, networks,
+                              volumes, devices, privileged, rolling_restart)
         insert_id = self.collection["apps"].insert_one(app_doc).inserted_id
         ignored_app_existence_status, result = self.mongo_get_app(app_name)
+        self.mongo_mark_app_device_group_configs_stale([app_name])
         return result
 
+    # apply many app operations with a single unordered bulk write, each operation is a tuple of its type (create,
+    # update, patch, start, stop or restart), the app_name & the app params it sets (for create, update & patch),
+    # returns the error of each operation that failed by its index in app_operations, a restart only restarts an app
+    # that is running, the device groups using the changed apps have their materialized configs marked stale once all
+    # the operations are applied
+    def mongo_bulk_update_apps(self, app_operations):
+        bulk_requests = []
+        for operation_type, app_name, app_params in app_operations:
+            if operation_type == "create":
+                bulk_requests.append(InsertOne(get_app_doc(app_name, **app_params)))
+            elif operation_type == "update" or operation_type == "patch":
+                bulk_requests.append(UpdateOne({'app_name': app_name}, {'$inc': {'app_id': 1}, '$set': app_params}))
+            elif operation_type == "start" or operation_type == "stop":
+                bulk_requests.append(UpdateOne({'app_name': app_name},
+                                               {'$inc': {'app_id': 1}, '$set': {'running': operation_type == "start"}}))
+            elif operation_type == "restart":
+                bulk_requests.append(UpdateOne({'app_name': app_name, 'running': True}, {'$inc': {'app_id': 1}}))
+        operation_errors = {}
+        try:
+            self.collection["apps"].bulk_write(bulk_requests, ordered=False)
+        except BulkWriteError as e:
+            for write_error in e.details["writeErrors"]:
+                operation_errors[write_error["index"]] = write_error["errmsg"]
+        changed_app_names = [app_name for index, (operation_type, app_name, app_params) in enumerate(app_operations)
+                             if index not in operation_errors]
+        if len(changed_app_names) > 0:
+            self.mongo_mark_app_device_group_configs_stale(changed_app_names)
+        return operation_errors
+
+    # get the query of the apps an app selector matches, a selector can have a docker_image_prefix, a list of
+    # device_groups the apps are used by & an app_name_pattern regex & the apps have to match all of the ones given
+    def mongo_get_app_selector_query(self, app_selector):
+        app_queries = []
+        if app_selector.get("docker_image_prefix") is not None:
+            app_queries.append({"docker_image": {"$regex": "^" + re.escape(app_selector["docker_image_prefix"])}})
+        if app_selector.get("device_groups") is not None:
+            app_names = set()
+            for device_group in self.collection["device_groups"].find(
+                    {"device_group": {"$in": app_selector["device_groups"]}}, {'_id': False, "apps": True}):
+                app_names.update(device_group["apps"])
+            app_queries.append({"app_name": {"$in": list(app_names)}})
+        if app_selector.get("app_name_pattern") is not None:
+            app_queries.append({"app_name": {"$regex": app_selector["app_name_pattern"]}})
+        return {"$and": app_queries} if len(app_queries) > 0 else {"app_name": {"$exists": True}}
+
+    # update all the apps an app selector matches with a single update_many that sets update_fields_dict & increases
+    # the app_id of each of them, allowed_app_names limits the update to those apps & running_only to the apps that are
+    # running, returns the new app_id of each updated app by its name
+    def mongo_update_selected_apps(self, app_selector, update_fields_dict=None, allowed_app_names=None,
+                                   running_only=False):
+        app_queries = [self.mongo_get_app_selector_query(app_selector)]
+        if allowed_app_names is not None:
+            app_queries.append({"app_name": {"$in": allowed_app_names}})
+        if running_only is True:
+            app_queries.append({"running": True})
+        app_names = []
+        for app in self.collection["apps"].find({"$and": app_queries}, {'_id': False, "app_name": True}):
+            app_names.append(app["app_name"])
+        if len(app_names) == 0:
+            return {}
+        app_update = {'$inc': {'app_id': 1}}
+        if update_fields_dict:
+            app_update['$set'] = update_fields_dict
+        self.collection["apps"].update_many({"$and": app_queries + [{"app_name": {"$in": app_names}}]}, app_update)
+        app_ids = {}
+        for app in self.collection["apps"].find({"app_name": {"$in": app_names}},
+                                                {'_id': False, "app_name": True, "app_id": True}):
+            app_ids[app["app_name"]] = app["app_id"]
+        self.mongo_mark_app_device_group_configs_stale(app_names)
+        return app_ids
+
     # remove app
     def mongo_remove_app(self, app_name):
         result = self.collection["apps"].delete_one({"app_name": app_name})
+        self.collection["app_rollouts"].delete_one({"_id": app_name})
+        self.mongo_notify_app_rollouts_listeners()
+        self.mongo_mark_app_device_group_configs_stale([app_name])
+        return result
+
+    # set the rollout policy of an app, while an app with a rollout policy has rolling_restart set each of its changes
+    # is rolled out to another batch_percent of the devices every interval seconds with the rest still getting its
+    # previous version, the app current version is kept as the one its next change is rolled out from
+    def mongo_set_app_rollout_policy(self, app_name, batch_percent, interval):
+        app_exists, app_json = self.mongo_get_app(app_name)
+        if app_exists is False:
+            return app_exists, None
+        rollout_start = time.time()
+        result = self.collection["app_rollouts"].find_one_and_update({"_id": app_name},
+                                                                     {'$set': {"batch_percent": batch_percent,
+                                                                               "interval": interval},
+                                                                      '$setOnInsert': {"current_app": app_json,
+                                                                                       "previous_app": None,
+                                                                                       "started_at": rollout_start,
+                                                                                       "finishes_at": rollout_start}},
+                                                                     upsert=True,
+                                                                     return_document=ReturnDocument.AFTER)
+        self.mongo_notify_app_rollouts_listeners()
+        return app_exists, result
+
+    # get the rollout policy & the state of the latest rollout of an app
+    def mongo_get_app_rollout(self, app_name):
+        result = self.collection["app_rollouts"].find_one({"_id": app_name})
+        if result is None:
+            app_rollout_exists = False
+        else:
+            app_rollout_exists = True
+        return app_rollout_exists, result
+
+    # remove the rollout policy of an app, its following changes are given to all the devices at once
+    def mongo_remove_app_rollout_policy(self, app_name):
+        result = self.collection["app_rollouts"].delete_one({"_id": app_name})
+        self.mongo_notify_app_rollouts_listeners()
         return result
 
+    # call all the app rollouts listeners
+    def mongo_notify_app_rollouts_listeners(self):
+        for app_rollouts_listener in self.app_rollouts_listeners:
+            app_rollouts_listener()
+
+    # list the app rollouts still in progress, an app without its previous version has nothing to roll out from
+    def mongo_list_active_app_rollouts(self):
+        app_rollouts = {}
+        for app_rollout in self.collection["app_rollouts"].find({"finishes_at": {"$gt": time.time()},
+                                                                  "previous_app": {"$ne": None}}):
+            app_rollouts[app_rollout["_id"]] = app_rollout
+        return app_rollouts
+
+    # start a rollout for each of the given apps that has a rollout policy & changed since its last rollout, a change
+    # made while a rollout is still in progress is rolled out from the same previous version so devices never get a
+    # version that wasn't fully rolled out as their previous one, apps without rolling_restart set have their rollout
+    # finish at once
+    def mongo_record_app_rollouts(self, app_names):
+        app_rollouts = {}
+        for app_rollout in self.collection["app_rollouts"].find({"_id": {"$in": app_names}}):
+            app_rollouts[app_rollout["_id"]] = app_rollout
+        if len(app_rollouts) == 0:
+            return
+        for app in self.collection["apps"].find({"app_name": {"$in": list(app_rollouts.keys())}}, {'_id': False}):
+            app_rollout = app_rollouts[app["app_name"]]
+            if app_rollout["current_app"]["app_id"] == app["app_id"]:
+                continue
+            rollout_start = time.time()
+            if app_rollout["finishes_at"] <= rollout_start:
+                previous_app = app_rollout["current_app"]
+            else:
+                previous_app = app_rollout["previous_app"]
+            if app.get("rolling_restart") is True:
+                rollout_finish = get_rollout_finish_time(rollout_start, app_rollout["batch_percent"],
+                                                         app_rollout["interval"])
+            else:
+                rollout_finish = rollout_start
+            self.collection["app_rollouts"].update_one({"_id": app["app_name"],
+                                                        "current_app.app_id": app_rollout["current_app"]["app_id"]},
+                                                       {'$set': {"current_app": app, "previous_app": previous_app,
+                                                                 "started_at": rollout_start,
+                                                                 "finishes_at": rollout_finish}})
+            self.mongo_notify_app_rollouts_listeners()
+
     # get app starting ports
     def mongo_list_app_starting_ports(self, app_name):
         result = self.collection["apps"].find_one({"app_name": app_name}, {'_id': False})
@@ -153,6 +420,7 @@ class MongoConnection:
                                                              {'$inc': {'app_id': 1},
                                                               '$set': {'starting_ports': starting_ports}},
                                                              return_document=ReturnDocument.AFTER)
+        self.mongo_mark_app_device_group_configs_stale([app_name])
         return result
 
     # increase app_id - used to restart the app
@@ -160,6 +428,7 @@ class MongoConnection:
         result = self.collection["apps"].find_one_and_update({'app_name': app_name},
                                                              {'$inc': {'app_id': 1}},
                                                              return_document=ReturnDocument.AFTER)
+        self.mongo_mark_app_device_group_configs_stale([app_name])
         return result
 
     # get app running\stopped state
@@ -173,6 +442,7 @@ class MongoConnection:
                                                              {'$inc': {'app_id': 1},
                                                               '$set': {'running': running}},
                                                              return_document=ReturnDocument.AFTER)
+        self.mongo_mark_app_device_group_configs_stale([app_name])
         return result
 
     # add device_group
@@ -185,7 +455,9 @@ class MongoConnection:
             "cron_jobs": cron_jobs
         }
         insert_id = self.collection["device_groups"].insert_one(app_doc).inserted_id
+        self.mongo_invalidate_device_group_references()
         ignored_device_group_existence_status, result = self.mongo_get_device_group(device_group)
+        self.mongo_mark_device_group_configs_stale([device_group])
         return result
 
     # increase prune_id - used to prune unused images of devices that are part of a device group
@@ -193,6 +465,7 @@ class MongoConnection:
         result = self.collection["device_groups"].find_one_and_update({'device_group': device_group},
                                                                       {'$inc': {'prune_id': 1}},
                                                                       return_document=ReturnDocument.AFTER)
+        self.mongo_mark_device_group_configs_stale([device_group])
         return result
 
     # list device_group
@@ -204,43 +477,338 @@ class MongoConnection:
             device_group_exists = True
         return device_group_exists, result
 
+    # get the config of a device group along with the data of all of its apps & cron jobs, this takes a single query per
+    # collection no matter how many apps & cron jobs the device group has
+    def mongo_get_device_group_config(self, device_group):
+        device_group_exists, device_group_json = self.mongo_get_device_group(device_group)
+        if device_group_exists is False:
+            return device_group_exists, None
+        apps = self.mongo_list_apps_by_name(device_group_json["apps"])
+        cron_jobs = self.mongo_list_cron_jobs_by_name(device_group_json["cron_jobs"])
+        device_group_config = {
+            "apps": apps,
+            "apps_list": [app["app_name"] for app in apps],
+            "prune_id": device_group_json["prune_id"],
+            "cron_jobs": cron_jobs,
+            "cron_jobs_list": [cron_job["cron_job_name"] for cron_job in cron_jobs],
+            "device_group_id": device_group_json["device_group_id"]
+        }
+        return device_group_exists, device_group_config
+
+    # get the version counters of a device group config - its device_group_id & prune_id along with the app_id of each
+    # of its apps & the cron_job_id of each of its cron jobs, only the counters are read from the materialized config so
+    # this is a lot lighter then getting the full device group config
+    def mongo_get_device_group_versions(self, device_group):
+        result = self.collection["device_group_configs"].find_one({"_id": device_group},
+                                                                  {"versions_json": True, "stale": True})
+        if is_device_group_config_fresh(result, "versions_json") is False:
+            device_group_exists, device_group_versions, ignored = \
+                self.mongo_rebuild_stale_device_group_config(device_group, result)
+            return device_group_exists, device_group_versions
+        return True, json.loads(result["versions_json"])
+
+    # get the changes of a device group config since the version counters a device already has, only the apps & cron
+    # jobs that were added or changed since then are returned in full along with the names of the ones that were removed
+    # & the current version counters (version_vector) the device should pass the next time, the apps the device isn't
+    # yet in the rollout waves of (held_back_apps is the previous version of each by its name) are compared & returned
+    # at their previous version so the delta matches the full config the device gets
+    def mongo_get_device_group_config_delta(self, device_group, since_versions, held_back_apps=None):
+        device_group_exists, device_group_versions = self.mongo_get_device_group_versions(device_group)
+        if device_group_exists is False:
+            return device_group_exists, None
+        if held_back_apps is None:
+            held_back_apps = {}
+        ignored, device_group_versions = apply_held_back_apps({"apps": []}, device_group_versions, held_back_apps)
+        since_apps = since_versions.get("apps") or {}
+        since_cron_jobs = since_versions.get("cron_jobs") or {}
+        changed_app_names = [app_name for app_name, app_id in device_group_versions["apps"].items()
+                             if since_apps.get(app_name) != app_id]
+        changed_cron_job_names = [cron_job_name for cron_job_name, cron_job_id in
+                                  device_group_versions["cron_jobs"].items()
+                                  if since_cron_jobs.get(cron_job_name) != cron_job_id]
+        current_app_names = [app_name for app_name in changed_app_names if app_name not in held_back_apps]
+        current_apps = {app["app_name"]: app for app in self.mongo_list_apps_by_name(current_app_names)} \
+            if current_app_names else {}
+        changed_apps = [held_back_apps[app_name] if app_name in held_back_apps else current_apps[app_name]
+                        for app_name in changed_app_names if app_name in held_back_apps or app_name in current_apps]
+        changed_cron_jobs = self.mongo_list_cron_jobs_by_name(changed_cron_job_names) if changed_cron_job_names else []
+        device_group_config_delta = {
+            "apps": changed_apps,
+            "apps_list": list(device_group_versions["apps"].keys()),
+            "removed_apps": [app_name for app_name in since_apps if app_name not in device_group_versions["apps"]],
+            "prune_id": device_group_versions["prune_id"],
+            "cron_jobs": changed_cron_jobs,
+            "cron_jobs_list": list(device_group_versions["cron_jobs"].keys()),
+            "removed_cron_jobs": [cron_job_name for cron_job_name in since_cron_jobs
+                                  if cron_job_name not in device_group_versions["cron_jobs"]],
+            "device_group_id": device_group_versions["device_group_id"],
+            "version_vector": device_group_versions
+        }
+        return device_group_exists, device_group_config_delta
+
+    # get the materialized config of a device group, it's returned along with its version counters & already serialized
+    # so it can be returned to devices as is, device groups that don't have a materialized config yet have it built now
+    def mongo_get_device_group_config_json(self, device_group):
+        result = self.collection["device_group_configs"].find_one({"_id": device_group})
+        if is_device_group_config_fresh(result, "config_json") is False:
+            return self.mongo_rebuild_stale_device_group_config(device_group, result)
+        return True, json.loads(result["versions_json"]), result["config_json"]
+
+    # rebuild a stale (or missing) materialized config read from the db (as stale_result), only one rebuild of each
+    # device group runs at a time in a process so many reads of a device group marked stale don't all rebuild it, reads
+    # that find a rebuild already running get the last config built (when there is one) instead of waiting for it &
+    # reads that waited for a rebuild use the config it saved
+    def mongo_rebuild_stale_device_group_config(self, device_group, stale_result):
+        with self.device_group_config_rebuilds_lock:
+            if device_group not in self.device_group_config_rebuilds:
+                self.device_group_config_rebuilds[device_group] = {"lock": threading.Lock(), "reads": 0}
+            device_group_config_rebuild = self.device_group_config_rebuilds[device_group]
+            device_group_config_rebuild["reads"] += 1
+        try:
+            if stale_result is not None and "versions_json" in stale_result:
+                if device_group_config_rebuild["lock"].acquire(blocking=False) is False:
+                    return True, json.loads(stale_result["versions_json"]), stale_result.get("config_json")
+            else:
+                device_group_config_rebuild["lock"].acquire()
+            try:
+                result = self.collection["device_group_configs"].find_one({"_id": device_group})
+                if is_device_group_config_fresh(result, "config_json") is True:
+                    return True, json.loads(result["versions_json"]), result["config_json"]
+                return self.mongo_rebuild_device_group_config(device_group)
+            finally:
+                device_group_config_rebuild["lock"].release()
+        finally:
+            with self.device_group_config_rebuilds_lock:
+                device_group_config_rebuild["reads"] -= 1
+                if device_group_config_rebuild["reads"] == 0:
+                    self.device_group_config_rebuilds.pop(device_group, None)
+
+    # rebuild the materialized config of a device group, each rebuild first increases the config build_id & only saves
+    # the config if no other rebuild (or marking it stale) started after it so a rebuild that read older data can never
+    # overwrite a newer one, the version counters are saved serialized as app & cron job names are not always valid
+    # MongoDB field names, a digest of the config is saved along with them as the counters restart at 1 when an app or a
+    # device group is deleted & created again so they alone can match a config with a different content
+    def mongo_rebuild_device_group_config(self, device_group):
+        # device groups that don't exist (like the ones devices with a wrong name poll) are checked first so they cost
+        # no write, other then removing the config of a device group that was deleted
+        if self.collection["device_groups"].find_one({"device_group": device_group}, {"_id": True}) is None:
+            if self.collection["device_group_configs"].delete_one({"_id": device_group}).deleted_count > 0:
+                self.mongo_notify_device_group_config_listeners(device_group)
+            return False, None, None
+        build = self.collection["device_group_configs"].find_one_and_update({"_id": device_group},
+                                                                            {'$inc': {'build_id': 1}},
+                                                                            upsert=True,
+                                                                            return_document=ReturnDocument.AFTER)
+        device_group_exists, device_group_config = self.mongo_get_device_group_config(device_group)
+        if device_group_exists is False:
+            self.collection["device_group_configs"].delete_one({"_id": device_group, "build_id": build["build_id"]})
+            self.mongo_notify_device_group_config_listeners(device_group)
+            return device_group_exists, None, None
+        device_group_versions = get_device_group_config_versions(device_group_config)
+        device_group_config_json = dumps(device_group_config)
+        device_group_versions["config_digest"] = get_config_digest(device_group_config_json)
+        self.collection["device_group_configs"].update_one({"_id": device_group, "build_id": build["build_id"]},
+                                                           {'$set': {"versions_json": json.dumps(device_group_versions),
+                                                                     "config_json": device_group_config_json},
+                                                            '$unset': {"stale": ""}})
+        self.mongo_notify_device_group_config_listeners(device_group)
+        return device_group_exists, device_group_versions, device_group_config_json
+
+    # call all the device group config listeners with the name of a device group whose config changed
+    def mongo_notify_device_group_config_listeners(self, device_group):
+        for device_group_config_listener in self.device_group_config_listeners:
+            device_group_config_listener(device_group)
+
+    # watch a collection (like the materialized device group configs) for changes made by any manager & call on_change
+    # with the _id of each document that changed, on_change is called with None when the watch starts (changes made
+    # before it started are unknown) or when the whole collection changes, this blocks for as long as the watch is open
+    # & raises an OperationFailure if change streams are not supported (like on a standalone mongod)
+    def mongo_watch_collection(self, collection_name, on_change):
+        with self.collection[collection_name].watch([{"$project": {"documentKey": True}}]) as change_stream:
+            on_change(None)
+            for change in change_stream:
+                if "documentKey" in change:
+                    on_change(change["documentKey"]["_id"])
+                else:
+                    on_change(None)
+
+    # list the device groups that reference an app or a cron job (object_type is either apps or cron_jobs), the apps &
+    # cron_jobs fields of device groups are indexed so this doesn't scan all the device groups
+    def mongo_list_device_group_references(self, object_type, object_name):
+        device_groups = []
+        for device_group in self.collection["device_groups"].find({object_type: object_name},
+                                                                  {'_id': False, "device_group": True}):
+            device_groups.append(device_group["device_group"])
+        return device_groups
+
+    # list the device groups that reference an app or a cron job from the map of them kept in memory, the map is
+    # invalidated each time a device group changes
+    def mongo_list_cached_device_group_references(self, object_type, object_name):
+        with self.device_group_references_lock:
+            device_groups = self.device_group_references_cache.get((object_type, object_name))
+            device_group_references_generation = self.device_group_references_generation
+        if device_groups is None:
+            device_groups = self.mongo_list_device_group_references(object_type, object_name)
+            with self.device_group_references_lock:
+                if device_group_references_generation == self.device_group_references_generation:
+                    self.device_group_references_cache[(object_type, object_name)] = device_groups
+        return list(device_groups)
+
+    # drop the in memory map of the device groups that reference each app & cron job
+    def mongo_invalidate_device_group_references(self):
+        with self.device_group_references_lock:
+            self.device_group_references_cache.clear()
+            self.device_group_references_generation += 1
+
+    # list the device groups that use an app
+    def mongo_list_app_device_groups(self, app_name):
+        return self.mongo_list_device_group_references("apps", app_name)
+
+    # list the device groups that use a cron job
+    def mongo_list_cron_job_device_groups(self, cron_job_name):
+        return self.mongo_list_device_group_references("cron_jobs", cron_job_name)
+
+    # mark the materialized configs of the given device groups as stale so each is rebuilt the next time it's read,
+    # they are all marked with a single update no matter how many there are & increasing their build_id stops rebuilds
+    # that started before from saving a config without the latest changes
+    def mongo_mark_device_group_configs_stale(self, device_groups):
+        if len(device_groups) > 0:
+            self.collection["device_group_configs"].update_many({"_id": {"$in": device_groups}},
+                                                                {'$set': {"stale": True}, '$inc': {'build_id': 1}})
+            for device_group in device_groups:
+                self.mongo_notify_device_group_config_listeners(device_group)
+
+    # mark the materialized configs of all the device groups that use any of the given apps as stale
+    def mongo_mark_app_device_group_configs_stale(self, app_names):
+        self.mongo_record_app_rollouts(app_names)
+        device_groups = []
+        for device_group in self.collection["device_groups"].find({"apps": {"$in": app_names}},
+                                                                  {'_id': False, "device_group": True}):
+            device_groups.append(device_group["device_group"])
+        self.mongo_mark_device_group_configs_stale(device_groups)
+        return device_groups
+
+    # mark the materialized configs of all the device groups that use any of the given cron jobs as stale
+    def mongo_mark_cron_job_device_group_configs_stale(self, cron_job_names):
+        device_groups = []
+        for device_group in self.collection["device_groups"].find({"cron_jobs": {"$in": cron_job_names}},
+                                                                  {'_id': False, "device_group": True}):
+            device_groups.append(device_group["device_group"])
+        self.mongo_mark_device_group_configs_stale(device_groups)
+        return device_groups
+
     # update device_group
     def mongo_update_device_group(self, device_group, update_fields_dict):
         result = self.collection["device_groups"].find_one_and_update({'device_group': device_group},
                                                                       {'$inc': {'device_group_id': 1},
                                                                        '$set': update_fields_dict},
                                                                       return_document=ReturnDocument.AFTER)
+        self.mongo_invalidate_device_group_references()
+        self.mongo_mark_device_group_configs_stale([device_group])
         return result
 
     # delete device_group
     def mongo_remove_device_group(self, device_group):
         result = self.collection["device_groups"].delete_one({"device_group": device_group})
+        self.mongo_invalidate_device_group_references()
+        self.mongo_mark_device_group_configs_stale([device_group])
         return result
 
-    # list all device groups
-    def mongo_list_device_groups(self):
+    # get the query of the device groups a device group selector matches, a selector can have a list of device_groups &
+    # a device_group_pattern regex & the device groups have to match all of the ones given, an empty selector matches
+    # all the device groups
+    def mongo_get_device_group_selector_query(self, device_group_selector):
+        device_group_queries = [{"device_group": {"$exists": True}}]
+        if device_group_selector.get("device_groups") is not None:
+            device_group_queries.append({"device_group": {"$in": device_group_selector["device_groups"]}})
+        if device_group_selector.get("device_group_pattern") is not None:
+            device_group_queries.append({"device_group": {"$regex": device_group_selector["device_group_pattern"]}})
+        return {"$and": device_group_queries}
+
+    # increase the prune_id of all the device groups a selector matches with a single update_many & then read their new
+    # prune_id with a single projected read, returns the new prune_id of each device group by its name
+    def mongo_prune_device_groups(self, device_group_selector):
+        device_group_query = self.mongo_get_device_group_selector_query(device_group_selector)
+        self.collection["device_groups"].update_many(device_group_query, {'$inc': {'prune_id': 1}})
+        prune_ids = {}
+        for device_group in self.collection["device_groups"].find(device_group_query, {'_id': False,
+                                                                                       "device_group": True,
+                                                                                       "prune_id": True}):
+            prune_ids[device_group["device_group"]] = device_group["prune_id"]
+        self.mongo_mark_device_group_configs_stale(list(prune_ids.keys()))
+        return prune_ids
+
+    # schedule the prune_id of all the device groups a selector matches to be increased at times spread evenly over the
+    # next stagger_window seconds so they don't all prune at once, the device groups are ordered by a hash of their name
+    # so similarly named ones are not pruned together, the schedule is saved with a single bulk write & the prunes are
+    # done once due by mongo_run_scheduled_prunes, returns the time (in epoch seconds) each device group will prune at
+    def mongo_schedule_device_groups_prune(self, device_group_selector, stagger_window):
+        device_group_query = self.mongo_get_device_group_selector_query(device_group_selector)
         device_groups = []
-        for device_group in self.collection["device_groups"].find({"device_group": {"$exists": "true"}},
-                                                                  {'_id': False}):
+        for device_group in self.collection["device_groups"].find(device_group_query,
+                                                                  {'_id': False, "device_group": True}):
             device_groups.append(device_group["device_group"])
+        device_groups.sort(key=lambda name: hashlib.sha1(name.encode('utf-8')).hexdigest())
+        schedule_start = time.time()
+        prune_schedule = {}
+        for index, device_group in enumerate(device_groups):
+            prune_schedule[device_group] = schedule_start + index * stagger_window / len(device_groups)
+        if len(prune_schedule) > 0:
+            bulk_requests = []
+            for device_group, prune_scheduled_at in prune_schedule.items():
+                bulk_requests.append(UpdateOne({"device_group": device_group},
+                                               {'$set': {"prune_scheduled_at": prune_scheduled_at}}))
+            self.collection["device_groups"].bulk_write(bulk_requests, ordered=False)
+        return prune_schedule
+
+    # increase the prune_id of all the device groups whose scheduled prune is due & clear their schedule, safe to run by
+    # many managers at once as each due prune is only done by the first one to update it, returns the device groups
+    # pruned
+    def mongo_run_scheduled_prunes(self):
+        due_time = time.time()
+        device_groups = []
+        for device_group in self.collection["device_groups"].find({"prune_scheduled_at": {"$lte": due_time}},
+                                                                  {'_id': False, "device_group": True}):
+            device_groups.append(device_group["device_group"])
+        if len(device_groups) > 0:
+            self.collection["device_groups"].update_many({"device_group": {"$in": device_groups},
+                                                          "prune_scheduled_at": {"$lte": due_time}},
+                                                         {'$inc': {'prune_id': 1},
+                                                          '$unset': {"prune_scheduled_at": ""}})
+            self.mongo_mark_device_group_configs_stale(device_groups)
         return device_groups
 
-    # get the reports of the user that match it's requested filtering in a paginated fashion starting with the last_id
-    # of the previous user request (or none if it's the first request)
-    def mango_list_paginated_filtered_reports(self, page_size=10, last_id=None, filters=None):
+    # list all device groups
+    def mongo_list_device_groups(self, limit=0, after=None):
+        return list(self.mongo_iterate_names("device_groups", "device_group", limit=limit, after=after))
+
+    # get a cursor over the reports that match the filters sorted by _id starting after last_id (if given), the query is
+    # hinted to use the index that matches the filters shape & is stopped after max_time_ms milliseconds (if given), the
+    # batch_size sets how many documents are fetched from MongoDB on each round trip when iterating over the cursor
+    def mongo_find_filtered_reports(self, filters=None, last_id=None, page_size=0, max_time_ms=None, batch_size=None):
         if filters is None:
             filters = {}
+        else:
+            filters = dict(filters)
 
         # if this isn't the first request start after the last _id of the previous request the user received
         if last_id is not None:
             filters['_id'] = {'$gt': ObjectId(last_id)}
 
-        # if there aren't any filters return a page of all reports
-        if filters == {}:
-            cursor = self.collection["reports"].find().limit(page_size).sort('_id', ASCENDING)
-        # if there are filters return a filtered page of the reports
-        else:
-            cursor = self.collection["reports"].find(filters).limit(page_size).sort('_id', ASCENDING)
+        cursor = self.collection["reports"].find(filters).sort('_id', ASCENDING).limit(page_size)
+        index_hint = get_reports_index_hint(filters, self.mongo_list_reports_index_names())
+        if index_hint is not None:
+            cursor = cursor.hint(index_hint)
+        if max_time_ms is not None:
+            cursor = cursor.max_time_ms(max_time_ms)
+        if batch_size is not None:
+            cursor = cursor.batch_size(batch_size)
+        return cursor
+
+    # get the reports of the user that match it's requested filtering in a paginated fashion starting with the last_id
+    # of the previous user request (or none if it's the first request)
+    def mango_list_paginated_filtered_reports(self, page_size=10, last_id=None, filters=None, max_time_ms=None):
+        cursor = self.mongo_find_filtered_reports(filters, last_id, page_size, max_time_ms)
 
         # Get the data
         data = [x for x in cursor]
@@ -255,12 +823,115 @@ class MongoConnection:
         # Return data and last_id
         return data, last_id
 
+    # get a summary of how MongoDB plans & runs the query of a page of filtered reports
+    def mongo_explain_filtered_reports(self, page_size=10, last_id=None, filters=None, max_time_ms=None):
+        cursor = self.mongo_find_filtered_reports(filters, last_id, page_size, max_time_ms)
+        return get_explain_summary(cursor.explain())
+
+    # store each report as the latest report of its hostname unless a newer report of it is already stored, the upsert
+    # of an older report fails on the duplicate hostname & is ignored so reports can be applied in any order & more then
+    # once (by many managers at once), reports without a hostname or a report_creation_time are skipped
+    def mongo_upsert_latest_reports(self, reports):
+        newest_reports = {}
+        for report in reports:
+            if report.get("hostname") is None or report.get("report_creation_time") is None:
+                continue
+            newest_report = newest_reports.get(report["hostname"])
+            if newest_report is None or newest_report["report_creation_time"] <= report["report_creation_time"]:
+                newest_reports[report["hostname"]] = report
+        bulk_requests = []
+        for report in newest_reports.values():
+            latest_report = dict(report)
+            latest_report["report_id"] = latest_report.pop("_id")
+            bulk_requests.append(UpdateOne({"_id": report["hostname"],
+                                            "report_creation_time": {"$lte": report["report_creation_time"]}},
+                                           {"$set": latest_report}, upsert=True))
+        if len(bulk_requests) > 0:
+            try:
+                self.collection["reports_latest"].bulk_write(bulk_requests, ordered=False)
+            except BulkWriteError as e:
+                for write_error in e.details["writeErrors"]:
+                    if write_error["code"] != 11000:
+                        raise
+
+    # move the latest reports checkpoint (the _id of the last report applied to the latest reports) forward, it never
+    # moves back so a slower manager finishing after a faster one doesn't make the reports be applied again
+    def mongo_set_latest_reports_checkpoint(self, last_report_id):
+        self.collection["settings"].update_one({"_id": "reports_latest_checkpoint"},
+                                               {'$max': {'last_report_id': last_report_id}}, upsert=True)
+
+    # seed the latest reports from all the reports up to the last one as of now, the reports of each hostname are
+    # sorted newest first & grouped so only the latest one is kept, returns how many hostnames were seeded
+    def mongo_seed_latest_reports(self, batch_size=1000):
+        last_report = self.collection["reports"].find_one({}, {"_id": True}, sort=[("_id", DESCENDING)])
+        if last_report is None:
+            return 0
+        seeded_hostnames = 0
+        latest_reports = self.collection["reports"].aggregate([
+            {"$match": {"_id": {"$lte": last_report["_id"]}}},
+            {"$sort": {"hostname": 1, "report_creation_time": -1}},
+            {"$group": {"_id": "$hostname", "report": {"$first": "$$ROOT"}}},
+            {"$replaceRoot": {"newRoot": "$report"}}
+        ], allowDiskUse=True, batchSize=batch_size)
+        reports_batch = []
+        for report in latest_reports:
+            reports_batch.append(report)
+            if len(reports_batch) >= batch_size:
+                self.mongo_upsert_latest_reports(reports_batch)
+                seeded_hostnames += len(reports_batch)
+                reports_batch = []
+        self.mongo_upsert_latest_reports(reports_batch)
+        seeded_hostnames += len(reports_batch)
+        self.mongo_set_latest_reports_checkpoint(last_report["_id"])
+        return seeded_hostnames
+
+    # apply the reports added since the latest reports checkpoint (seeding them first if there is no checkpoint yet) in
+    # batches of batch_size reports, the _id is created by the reporting side so reports aren't always inserted in _id
+    # order (clock skew, reports buffered before being inserted) so once every overlap_time seconds (claimed in the
+    # checkpoint so only one manager does it) an update starts 2 * overlap_time seconds before the checkpoint to apply
+    # reports inserted after newer ones, only reports inserted more then overlap_time seconds after their _id was
+    # created are missed, returns how many reports were applied
+    def mongo_update_latest_reports(self, batch_size=1000, overlap_time=300):
+        checkpoint = self.collection["settings"].find_one({"_id": "reports_latest_checkpoint"})
+        if checkpoint is None:
+            return self.mongo_seed_latest_reports(batch_size)
+        last_report_id = checkpoint["last_report_id"]
+        now = datetime.datetime.utcnow()
+        overlap_scan_due_at = now - datetime.timedelta(seconds=overlap_time)
+        if checkpoint.get("overlap_scanned_at") is None or checkpoint["overlap_scanned_at"] <= overlap_scan_due_at:
+            overlap_scan_claimed = self.collection["settings"].find_one_and_update(
+                {"_id": "reports_latest_checkpoint",
+                 "$or": [{"overlap_scanned_at": {"$exists": False}},
+                         {"overlap_scanned_at": {"$lte": overlap_scan_due_at}}]},
+                {"$set": {"overlap_scanned_at": now}})
+            if overlap_scan_claimed is not None:
+                last_report_id = ObjectId.from_datetime(last_report_id.generation_time -
+                                                        datetime.timedelta(seconds=2 * overlap_time))
+        applied_reports = 0
+        while True:
+            reports = list(self.collection["reports"].find({"_id": {"$gt": last_report_id}})
+                           .sort("_id", ASCENDING).limit(batch_size).hint("_id_"))
+            if len(reports) == 0:
+                break
+            self.mongo_upsert_latest_reports(reports)
+            last_report_id = reports[-1]["_id"]
+            self.mongo_set_latest_reports_checkpoint(last_report_id)
+            applied_reports += len(reports)
+            if len(reports) < batch_size:
+                break
+        return applied_reports
+
+    # list the latest report of each hostname sorted by hostname, only of the hostnames whose latest report is from the
+    # device_group if given
+    def mongo_list_latest_reports(self, device_group=None):
+        query = {}
+        if device_group is not None:
+            query["device_group"] = device_group
+        return list(self.collection["reports_latest"].find(query).sort("_id", ASCENDING))
+
     # list all users
-    def mongo_list_users(self):
-        users_list = []
-        for user in self.collection["users"].find({"user_name": {"$exists": "true"}}, {'_id': False}):
-            users_list.append(user["user_name"])
-        return users_list
+    def mongo_list_users(self, limit=0, after=None):
+        return list(self.mongo_iterate_names("users", "user_name", limit=limit, after=after))
 
     # check if user exists
     def mongo_check_user_exists(self, user_name):
@@ -281,18 +952,45 @@ class MongoConnection:
             user_exists = True
         return user_exists, result
 
+    # get the info of the user a token_id belongs to
+    def mongo_get_user_by_token_id(self, token_id):
+        result = self.collection["users"].find_one({"token_id": token_id}, {'_id': False})
+        if result is None:
+            user_exists = False
+        else:
+            user_exists = True
+        return user_exists, result
+
+    # check if a token_id is already used by a user other then user_name, token_ids are unique so a token given by the
+    # client can't be used if its token_id is already taken by another user
+    def mongo_check_token_id_taken(self, token_id, user_name=None):
+        result = self.collection["users"].find_one({"token_id": token_id, "user_name": {"$ne": user_name}},
+                                                   {'_id': False, "user_name": True})
+        return result is not None
+
+    # list the users that still use a legacy token (one without a token_id), only the user name & the hashed token are
+    # returned as that's all that's needed to check a token against them
+    def mongo_list_legacy_token_users(self):
+        users_list = []
+        find_query = {"$and": [{"user_name": {"$exists": "true"}}, {"token_id": None}]}
+        for user in self.collection["users"].find(find_query, {'_id': False, "user_name": True, "token": True}):
+            users_list.append(user)
+        return users_list
+
     # delete a user
     def mongo_delete_user(self, user_name):
         result = self.collection["users"].delete_one({"user_name": user_name})
+        self.mongo_increase_permissions_version()
         return result
 
     # create a user - make sure to hash the password & token before using this function as it does not hash anything on
     # it's own
-    def mongo_add_user(self, user_name, password, token):
+    def mongo_add_user(self, user_name, password, token, token_id=None):
         user_doc = {
             "user_name": user_name,
             "password": password,
-            "token": token
+            "token": token,
+            "token_id": token_id
         }
         insert_id = self.collection["users"].insert_one(user_doc).inserted_id
         ignored_device_group_existence_status, result = self.mongo_get_user(user_name)
@@ -304,6 +1002,7 @@ class MongoConnection:
         result = self.collection["users"].find_one_and_update({'user_name': user_name},
                                                               {'$set': update_fields_dict},
                                                               return_document=ReturnDocument.AFTER)
+        self.mongo_increase_permissions_version()
         return result
 
     # create a user_group
@@ -318,6 +1017,7 @@ class MongoConnection:
             "cron_jobs": cron_jobs
         }
         insert_id = self.collection["user_groups"].insert_one(user_group_doc).inserted_id
+        self.mongo_increase_permissions_version()
         ignored_device_group_existence_status, result = self.mongo_get_user_group(user_group)
         return result
 
@@ -326,19 +1026,18 @@ class MongoConnection:
         result = self.collection["user_groups"].find_one_and_update({'user_group': user_group},
                                                                     {'$set': update_fields_dict},
                                                                     return_document=ReturnDocument.AFTER)
+        self.mongo_increase_permissions_version()
         return result
 
     # delete a user_group
     def mongo_delete_user_group(self, user_group):
         result = self.collection["user_groups"].delete_one({"user_group": user_group})
+        self.mongo_increase_permissions_version()
         return result
 
     # list all user_groups
-    def mongo_list_user_groups(self):
-        user_groups_list = []
-        for user_group in self.collection["user_groups"].find({"user_group": {"$exists": "true"}}, {'_id': False}):
-            user_groups_list.append(user_group["user_group"])
-        return user_groups_list
+    def mongo_list_user_groups(self, limit=0, after=None):
+        return list(self.mongo_iterate_names("user_groups", "user_group", limit=limit, after=after))
 
     # get user_group info
     def mongo_get_user_group(self, user_group):
@@ -349,11 +1048,66 @@ class MongoConnection:
             user_group_exists = True
         return user_group_exists, result
 
-    # return a aggregated view of all groups that a user is a member of
+    # return a aggregated view of all groups that a user is a member of, the view is compiled once and then kept in
+    # memory until a user_group changes so checking a user permissions doesn't need to query the DB each time, the
+    # returned view is shared between callers so it must not be changed
     def mongo_list_user_permissions(self, user_name):
+        permissions_version = self.mongo_get_permissions_version()
+        with self.user_permissions_lock:
+            if permissions_version != self.user_permissions_version:
+                self.user_permissions_cache.clear()
+                self.user_permissions_generation += 1
+                self.user_permissions_version = permissions_version
+            user_permissions = self.user_permissions_cache.get(user_name)
+            user_permissions_generation = self.user_permissions_generation
+        if user_permissions is None:
+            user_permissions = self.mongo_compile_user_permissions(user_name)
+            with self.user_permissions_lock:
+                if user_permissions_generation == self.user_permissions_generation:
+                    self.user_permissions_cache[user_name] = user_permissions
+        return user_permissions
+
+    # forget all compiled user permissions, used whenever the permissions version is increased as a user_group change
+    # can change the permissions of any of its current or former members
+    def mongo_invalidate_user_permissions(self):
+        with self.user_permissions_lock:
+            self.user_permissions_cache.clear()
+            self.user_permissions_generation += 1
+
+    # get the current permissions version, it's increased whenever a user or a user_group changes & sessions created
+    # with an older version are no longer valid, the version is kept in memory for a short while so checking it doesn't
+    # usually query the DB
+    def mongo_get_permissions_version(self):
+        with self.user_permissions_lock:
+            permissions_version = self.permissions_version_cache.get("permissions_version")
+        if permissions_version is None:
+            result = self.collection["settings"].find_one({"_id": "permissions_version"})
+            if result is None:
+                permissions_version = 0
+            else:
+                permissions_version = result["version"]
+            with self.user_permissions_lock:
+                self.permissions_version_cache["permissions_version"] = permissions_version
+        return permissions_version
+
+    # increase the permissions version, this revokes all current sessions & drops all compiled user permissions
+    def mongo_increase_permissions_version(self):
+        result = self.collection["settings"].find_one_and_update({"_id": "permissions_version"},
+                                                                 {'$inc': {'version': 1}},
+                                                                 upsert=True,
+                                                                 return_document=ReturnDocument.AFTER)
+        with self.user_permissions_lock:
+            self.permissions_version_cache["permissions_version"] = result["version"]
+            self.user_permissions_version = result["version"]
+        self.mongo_invalidate_user_permissions()
+        return result["version"]
+
+    # compile the permissions of all groups that a user is a member of into a single view, the permissions of each
+    # object type are a dict of the object name & the permission given to it so checking them is a single lookup
+    def mongo_compile_user_permissions(self, user_name):
         user_permissions = {"apps": {}, "device_groups": {}, "admin": False, "pruning_allowed": False, "cron_jobs": {}}
         find_query = {"$and": [{"user_group": {"$exists": "true"}}, {"group_members": user_name}]}
-        for user_group in self.collection["user_groups"].find(find_query, {'_id': False}):
+        for user_group in self.collection["user_groups"].find(find_query, {'_id': False, 'group_members': False}):
             if user_group["admin"] is True:
                 user_permissions["admin"] = True
             if user_group["pruning_allowed"] is True:
@@ -386,15 +1140,12 @@ class MongoConnection:
         }
         insert_id = self.collection["cron_jobs"].insert_one(cron_job_doc).inserted_id
         ignored_cron_job_existence_status, result = self.mongo_get_cron_job(cron_job_name)
+        self.mongo_mark_cron_job_device_group_configs_stale([cron_job_name])
         return result
 
     # list all cron jobs
-    def mongo_list_cron_jobs(self):
-        cron_jobs = []
-        for cron_job in self.collection["cron_jobs"].find({"cron_job_name": {"$exists": "true"}},
-                                                          {'_id': False}):
-            cron_jobs.append(cron_job["cron_job_name"])
-        return cron_jobs
+    def mongo_list_cron_jobs(self, limit=0, after=None):
+        return list(self.mongo_iterate_names("cron_jobs", "cron_job_name", limit=limit, after=after))
 
     # get all cron job data
     def mongo_get_cron_job(self, cron_job_name):
@@ -405,20 +1156,139 @@ class MongoConnection:
             cron_job_exists = True
         return cron_job_exists, result
 
+    # get all the data of a list of cron jobs with a single query, cron jobs that don't exist are left out & the rest
+    # are returned in the order they were asked for
+    def mongo_list_cron_jobs_by_name(self, cron_job_names):
+        cron_jobs = {}
+        for cron_job in self.collection["cron_jobs"].find({"cron_job_name": {"$in": cron_job_names}}, {'_id': False}):
+            cron_jobs[cron_job["cron_job_name"]] = cron_job
+        return [cron_jobs[cron_job_name] for cron_job_name in cron_job_names if cron_job_name in cron_jobs]
+
+    # list the cron jobs out of the given ones that don't exist
+    def mongo_list_missing_cron_jobs(self, cron_job_names):
+        return self.mongo_list_missing_names("cron_jobs", "cron_job_name", cron_job_names)
+
     # update some fields of an cron_job
     def mongo_update_cron_job_fields(self, cron_job_name, update_fields_dict):
         result = self.collection["cron_jobs"].find_one_and_update({'cron_job_name': cron_job_name},
                                                                   {'$inc': {'cron_job_id': 1},
                                                                    '$set': update_fields_dict},
                                                                   return_document=ReturnDocument.AFTER)
+        self.mongo_mark_cron_job_device_group_configs_stale([cron_job_name])
         return result
 
     # delete a cron_job
     def mongo_delete_cron_job(self, cron_job):
         result = self.collection["cron_jobs"].delete_one({"cron_job_name": cron_job})
+        self.mongo_mark_cron_job_device_group_configs_stale([cron_job])
         return result
 
     # check if cron_job exists
     def mongo_check_cron_job_exists(self, cron_job):
         result, ignored = self.mongo_get_cron_job(cron_job)
         return result
+
+
+# the compound indexes of the reports by name, each starts with the fields the filter shape it serves matches on & ends
+# with the _id the reports are sorted & paginated by
+REPORTS_INDEXES = {
+    "reports_hostname_index": [("hostname", ASCENDING), ("_id", ASCENDING)],
+    "reports_device_group_index": [("device_group", ASCENDING), ("_id", ASCENDING)],
+    "reports_device_group_updated_index": [("device_group", ASCENDING), ("updated", ASCENDING), ("_id", ASCENDING)],
+    "reports_creation_time_index": [("report_creation_time", ASCENDING), ("_id", ASCENDING)]
+}
+
+
+# returns the name of the index a reports query with the given filters should use, the hostname is the most selective
+# filter followed by the device_group (narrowed by updated when both are given) & the report_creation_time while reports
+# filtered only by updated (or not at all) are read in _id order, None is returned (leaving the query for MongoDB to
+# plan) when the index isn't one of the index_names given as existing
+def get_reports_index_hint(filters, index_names=None):
+    if "hostname" in filters:
+        index_hint = "reports_hostname_index"
+    elif "device_group" in filters and "updated" in filters:
+        index_hint = "reports_device_group_updated_index"
+    elif "device_group" in filters:
+        index_hint = "reports_device_group_index"
+    elif "report_creation_time" in filters:
+        index_hint = "reports_creation_time_index"
+    else:
+        return "_id_"
+    if index_names is not None and index_hint not in index_names:
+        return None
+    return index_hint
+
+
+# returns a summary of a query explain output - the index used, the stages of the winning plan & how many keys &
+# documents were examined to return how many documents in how long
+def get_explain_summary(explain):
+    query_planner = explain.get("queryPlanner", {})
+    execution_stats = explain.get("executionStats", {})
+    plan_stages = []
+    index_names = []
+    plan_stage = query_planner.get("winningPlan", {})
+    while plan_stage:
+        plan_stages.append(plan_stage.get("stage"))
+        if "indexName" in plan_stage:
+            index_names.append(plan_stage["indexName"])
+        plan_stage = plan_stage.get("inputStage") or (plan_stage.get("inputStages") or [None])[0]
+    explain_summary = {
+        "stages": plan_stages,
+        "indexes": index_names,
+        "keys_examined": execution_stats.get("totalKeysExamined"),
+        "docs_examined": execution_stats.get("totalDocsExamined"),
+        "returned": execution_stats.get("nReturned"),
+        "execution_time_ms": execution_stats.get("executionTimeMillis")
+    }
+    return explain_summary
+
+
+# returns a new app document, the lists are created inside the function to avoid mutable default values
+def get_app_doc(app_name, starting_ports, containers_per, env_vars, docker_image, running=True, networks=None,
+                volumes=None, devices=None, privileged=False, rolling_restart=False):
+    if volumes is None:
+        volumes = []
+    if devices is None:
+        devices = []
+    if networks is None:
+        networks = ["nebula"]
+    app_doc = {
+        "app_id": 1,
+        "app_name": app_name,
+        "starting_ports": starting_ports,
+        "containers_per": containers_per,
+        "env_vars": env_vars,
+        "docker_image": docker_image,
+        "running": running,
+        "networks": networks,
+        "volumes": volumes,
+        "devices": devices,
+        "privileged": privileged,
+        "rolling_restart": rolling_restart
+    }
+    return app_doc
+
+
+# check if a materialized device group config read from the db has the given field & isn't marked stale
+def is_device_group_config_fresh(device_group_config_result, field_name):
+    if device_group_config_result is None or field_name not in device_group_config_result:
+        return False
+    return device_group_config_result.get("stale") is not True
+
+
+# returns a digest of a serialized device group config
+def get_config_digest(device_group_config_json):
+    return hashlib.sha256(device_group_config_json.encode('utf-8')).hexdigest()[:16]
+
+
+# returns the version counters of a device group config - its device_group_id & prune_id along with the app_id of each
+# of its apps & the cron_job_id of each of its cron jobs
+def get_device_group_config_versions(device_group_config):
+    device_group_versions = {
+        "device_group_id": device_group_config["device_group_id"],
+        "prune_id": device_group_config["prune_id"],
+        "apps": {app["app_name"]: app["app_id"] for app in device_group_config["apps"]},
+        "cron_jobs": {cron_job["cron_job_name"]: cron_job["cron_job_id"]
+                      for cron_job in device_group_config["cron_jobs"]}
+    }
+    return device_group_versions
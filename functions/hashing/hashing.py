@@ -1,4 +1,15 @@
-import bcrypt
+import bcrypt, secrets, re, hmac, hashlib, threading, time, json, base64
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
+
+
+# tokens are made of a public token_id which is used to find the user the token belongs to followed by the secret part
+# of the token, legacy tokens (created before the token_id was added) are made only of a secret part
+TOKEN_ID_SEPARATOR = "."
+TOKEN_ID_PATTERN = re.compile(r"^([0-9a-f]{16})\.(.+)$")
+
+# session tokens are made of this prefix followed by the session payload & the HMAC signature of it
+SESSION_TOKEN_PREFIX = "session."
 
 
 def hash_secret(value_to_hash):
@@ -11,3 +22,180 @@ def check_secret_matches(value_to_check, hashed_value):
         return True
     else:
         return False
+
+
+# raised when more secrets are waiting to be hashed\checked then the hashing pool queue allows
+class HashingQueueFull(Exception):
+    pass
+
+
+# returns a new random token in the "<token_id>.<secret>" format
+def generate_token():
+    return secrets.token_hex(8) + TOKEN_ID_SEPARATOR + secrets.token_urlsafe()
+
+
+# returns the token_id of a token or None if it's a legacy token that doesn't have one
+def get_token_id(token):
+    token_match = TOKEN_ID_PATTERN.match(token)
+    if token_match is None:
+        return None
+    else:
+        return token_match.group(1)
+
+
+# returns a session token for the user which is valid until it expires or the permissions version changes, the token is
+# signed with the session key so it can later be checked without querying the DB
+def create_session_token(session_key, user_name, permissions_version, session_ttl):
+    session = {"user_name": user_name, "permissions_version": permissions_version,
+               "expires": int(time.time()) + session_ttl}
+    payload = base64.urlsafe_b64encode(json.dumps(session, separators=(",", ":")).encode('utf-8')).decode('utf-8')
+    return SESSION_TOKEN_PREFIX + payload + "." + session_signature(session_key, payload)
+
+
+# returns the session of a session token or None if the token is not signed with the session key or has expired
+def read_session_token(session_key, token):
+    try:
+        payload, signature = token[len(SESSION_TOKEN_PREFIX):].split(".")
+        if hmac.compare_digest(signature, session_signature(session_key, payload)) is False:
+            return None
+        session = json.loads(base64.urlsafe_b64decode(payload.encode('utf-8')))
+    except (ValueError, TypeError):
+        return None
+    if session["expires"] < time.time():
+        return None
+    return session
+
+
+# returns the signature of a session token payload
+def session_signature(session_key, payload):
+    return hmac.new(session_key, payload.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+# a bounded & time limited memory of recently verified secrets which allows repeated requests with the same credentials
+# to skip the bcrypt check, the secrets themselves are never kept, only a keyed digest of them using a random key that
+# only lives in the memory of the current process, each secret is remembered along with the permissions version it was
+# verified at so that changing or deleting any user (which changes the permissions version) in any process stops it
+# from being matched
+class VerifiedSecretsCache:
+
+    def __init__(self, max_size=1024, ttl=60):
+        self.digest_key = secrets.token_bytes(32)
+        self.cache = TTLCache(maxsize=max_size, ttl=ttl)
+        self.lock = threading.Lock()
+
+    # returns a keyed digest of the secret, the secret type & the user name (if known before checking the secret, as is
+    # the case with passwords) are part of the cache key so a secret is only matched against what it was verified as
+    def cache_key(self, secret_type, secret, login_name):
+        secret_digest = hmac.new(self.digest_key, secret.encode('utf-8'), hashlib.sha256).digest()
+        return secret_type, login_name, secret_digest
+
+    # returns the name of the user the secret was recently verified for at the same permissions version or None if it
+    # wasn't
+    def get_verified_user(self, secret_type, secret, login_name=None, permissions_version=None):
+        cache_key = self.cache_key(secret_type, secret, login_name)
+        with self.lock:
+            verified_secret = self.cache.get(cache_key)
+            if verified_secret is None:
+                return None
+            user_name, verified_permissions_version = verified_secret
+            if verified_permissions_version != permissions_version:
+                self.cache.pop(cache_key, None)
+                return None
+            return user_name
+
+    # remember that the secret was verified as belonging to the user at the permissions version
+    def add_verified_secret(self, secret_type, secret, user_name, login_name=None, permissions_version=None):
+        cache_key = self.cache_key(secret_type, secret, login_name)
+        with self.lock:
+            self.cache[cache_key] = (user_name, permissions_version)
+
+    # forget all the secrets verified for a user, used whenever a user is changed or deleted
+    def invalidate_user(self, user_name):
+        with self.lock:
+            for cache_key, verified_secret in list(self.cache.items()):
+                if verified_secret[0] == user_name:
+                    self.cache.pop(cache_key, None)
+
+
+# runs the bcrypt hashing & checking on a bounded pool of native threads, bcrypt releases the GIL while it works so this
+# keeps the CPU time it takes from blocking the gevent hub (and with it every other request), when not running under
+# gevent (like when using the flask dev server) a regular thread pool is used instead
+class HashingPool:
+
+    def __init__(self, pool_size=2, max_queue_size=64):
+        self.pool_size = pool_size
+        self.max_queue_size = max_queue_size
+        self.pool = None
+        self.gevent_pool = False
+        self.lock = threading.Lock()
+        self.pending_tasks = 0
+        self.completed_tasks = 0
+        self.rejected_tasks = 0
+        self.queue_wait_time_total = 0.0
+        self.queue_wait_time_max = 0.0
+
+    # the pool is only created on first use so that it's created after gunicorn forks & patches the worker
+    def get_pool(self):
+        if self.pool is None:
+            try:
+                from gevent import monkey
+                self.gevent_pool = monkey.is_module_patched("threading")
+            except ImportError:
+                self.gevent_pool = False
+            if self.gevent_pool is True:
+                from gevent.threadpool import ThreadPool
+                self.pool = ThreadPool(self.pool_size)
+            else:
+                self.pool = ThreadPoolExecutor(max_workers=self.pool_size)
+        return self.pool
+
+    # run a function on the pool & wait for it to finish, the time it waited in the queue before starting is returned
+    # along with the function result
+    def run(self, func, *args):
+        with self.lock:
+            if self.pending_tasks >= self.pool_size + self.max_queue_size:
+                self.rejected_tasks += 1
+                raise HashingQueueFull()
+            self.pending_tasks += 1
+        try:
+            submit_time = time.monotonic()
+            pool = self.get_pool()
+            if self.gevent_pool is True:
+                start_time, result = pool.apply(timed_call, (func,) + args)
+            else:
+                start_time, result = pool.submit(timed_call, func, *args).result()
+        finally:
+            with self.lock:
+                self.pending_tasks -= 1
+        queue_wait_time = start_time - submit_time
+        with self.lock:
+            self.completed_tasks += 1
+            self.queue_wait_time_total += queue_wait_time
+            self.queue_wait_time_max = max(self.queue_wait_time_max, queue_wait_time)
+        return result
+
+    def hash_secret(self, value_to_hash):
+        return self.run(hash_secret, value_to_hash)
+
+    def check_secret_matches(self, value_to_check, hashed_value):
+        return self.run(check_secret_matches, value_to_check, hashed_value)
+
+    # returns the pool counters, wait times are in seconds
+    def get_stats(self):
+        with self.lock:
+            stats = {
+                "pool_size": self.pool_size,
+                "max_queue_size": self.max_queue_size,
+                "pending_tasks": self.pending_tasks,
+                "completed_tasks": self.completed_tasks,
+                "rejected_tasks": self.rejected_tasks,
+                "queue_wait_time_total": self.queue_wait_time_total,
+                "queue_wait_time_max": self.queue_wait_time_max
+            }
+        return stats
+
+
+# runs a function & returns the time it started running along with its result
+def timed_call(func, *args):
+    start_time = time.monotonic()
+    return start_time, func(*args)
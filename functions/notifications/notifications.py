@@ -0,0 +1,43 @@
+import threading
+from contextlib import contextmanager
+
+
+# lets any number of listeners wait for a change to be announced on a key (like a device group name), each listener
+# registers an event under the key so a single announcement wakes all of the key listeners at once
+class ChangeNotifier:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.listeners = {}
+
+    # register a listener on a key for as long as the context is open & return its event, the event is set when a change
+    # is announced on the key so registering before checking the current state means no change can be missed
+    @contextmanager
+    def listen(self, key):
+        change_event = threading.Event()
+        with self.lock:
+            self.listeners.setdefault(key, set()).add(change_event)
+        try:
+            yield change_event
+        finally:
+            with self.lock:
+                key_listeners = self.listeners[key]
+                key_listeners.discard(change_event)
+                if len(key_listeners) == 0:
+                    del self.listeners[key]
+
+    # announce a change on a key (or on all keys if None is given) waking all of its listeners
+    def notify(self, key):
+        with self.lock:
+            if key is None:
+                change_events = [change_event for key_listeners in self.listeners.values()
+                                 for change_event in key_listeners]
+            else:
+                change_events = list(self.listeners.get(key, ()))
+        for change_event in change_events:
+            change_event.set()
+
+    # returns the number of listeners currently registered on a key
+    def count_listeners(self, key):
+        with self.lock:
+            return len(self.listeners.get(key, ()))
@@ -0,0 +1,62 @@
+import hashlib, math, json
+
+
+# returns the time a rollout started at started_at finishes at, each interval seconds another batch_percent of the
+# devices gets the new app version so the last wave starts once all the waves before it had their interval
+def get_rollout_finish_time(started_at, batch_percent, interval):
+    return started_at + interval * (math.ceil(100 / batch_percent) - 1)
+
+
+# returns the percent of the devices that get the new app version of a rollout at a given time
+def get_rollout_wave_percent(app_rollout, at_time):
+    if at_time >= app_rollout["finishes_at"]:
+        return 100
+    rollout_waves = int((at_time - app_rollout["started_at"]) // app_rollout["interval"]) + 1
+    return min(100, app_rollout["batch_percent"] * rollout_waves)
+
+
+# returns the bucket (0-99) of a device in the rollouts of an app, a device always lands in the same bucket of an app so
+# the same devices are the first to get each of its new versions
+def get_rollout_bucket(app_name, device):
+    device_hash = hashlib.sha256((app_name + "/" + device).encode('utf-8')).hexdigest()
+    return int(device_hash[:8], 16) % 100
+
+
+# check if a device already gets the new app version of a rollout at a given time
+def is_device_in_rollout_wave(app_rollout, device, at_time):
+    return get_rollout_bucket(app_rollout["_id"], device) < get_rollout_wave_percent(app_rollout, at_time)
+
+
+# returns a device group config & its version counters with the given apps (held_back_apps is the previous version of
+# each app by its name) replacing the current version of those apps, the config digest (when there is one) is replaced
+# by a digest of it & the apps held back as the previous app versions are part of the config content
+def apply_held_back_apps(device_group_config, device_group_versions, held_back_apps):
+    device_group_config = dict(device_group_config)
+    device_group_config["apps"] = [held_back_apps.get(app["app_name"], app) for app in device_group_config["apps"]]
+    device_group_versions = dict(device_group_versions)
+    device_group_versions["apps"] = dict(device_group_versions["apps"])
+    applied_apps = {}
+    for app_name, held_back_app in held_back_apps.items():
+        if app_name in device_group_versions["apps"]:
+            device_group_versions["apps"][app_name] = held_back_app["app_id"]
+            applied_apps[app_name] = held_back_app
+    if "config_digest" in device_group_versions and len(applied_apps) > 0:
+        held_back_json = json.dumps([device_group_versions["config_digest"], applied_apps], sort_keys=True, default=str)
+        device_group_versions["config_digest"] = hashlib.sha256(held_back_json.encode('utf-8')).hexdigest()[:16]
+    return device_group_config, device_group_versions
+
+
+# returns the progress of the latest rollout of an app at a given time along with its rollout policy
+def get_rollout_progress(app_rollout, at_time):
+    rollout_progress = {
+        "app_name": app_rollout["_id"],
+        "batch_percent": app_rollout["batch_percent"],
+        "interval": app_rollout["interval"],
+        "app_id": app_rollout["current_app"]["app_id"],
+        "previous_app_id": app_rollout["previous_app"]["app_id"] if app_rollout["previous_app"] is not None else None,
+        "started_at": app_rollout["started_at"],
+        "finishes_at": app_rollout["finishes_at"],
+        "rolled_out_percent": get_rollout_wave_percent(app_rollout, at_time),
+        "finished": at_time >= app_rollout["finishes_at"]
+    }
+    return rollout_progress
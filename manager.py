@@ -1,10 +1,14 @@
-import json, secrets, ast
-from flask import json, Flask, request, g, jsonify
+import json, secrets, ast, hashlib, threading, time, re, zlib
+from flask import json, Flask, request, g, jsonify, make_response, Response, stream_with_context
 from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth, MultiAuth
 from functions.db.mongo import *
 from functions.hashing.hashing import *
+from functions.notifications.notifications import *
+from functions.cache.cache import *
+from functions.rollouts.rollouts import *
 from bson.json_util import dumps
 from cachetools import cached, TTLCache
+from pymongo.errors import OperationFailure, PyMongoError, ExecutionTimeout, DuplicateKeyError
 from retrying import retry
 from functools import wraps
 from croniter import croniter
@@ -60,6 +64,34 @@ def check_ports_valid_range(checked_ports):
     return "all ports checked are in a valid 1-65535 range", 200
 
 
+# check for edge case of the apps or cron_jobs (list_name) of a device group not being a list of names
+def check_names_list(checked_names, list_name):
+    if type(checked_names) is not list:
+        return json.dumps({list_name + "_is_list": False}), 400
+    for checked_name in checked_names:
+        if type(checked_name) is not str:
+            return json.dumps({list_name + "_are_names": False}), 400
+    return "all names checked are a list of strings", 200
+
+
+# get the params of an app from a request body with the ones not given set to their default values, raises a KeyError if
+# the required docker_image is not given
+def get_app_params(app_json, env_vars_default):
+    app_params = {
+        "starting_ports": return_sane_default_if_not_declared("starting_ports", app_json, []),
+        "containers_per": return_sane_default_if_not_declared("containers_per", app_json, {"server": 1}),
+        "env_vars": return_sane_default_if_not_declared("env_vars", app_json, env_vars_default),
+        "docker_image": app_json["docker_image"],
+        "running": return_sane_default_if_not_declared("running", app_json, True),
+        "networks": return_sane_default_if_not_declared("networks", app_json, ["nebula", "bridge"]),
+        "volumes": return_sane_default_if_not_declared("volumes", app_json, []),
+        "devices": return_sane_default_if_not_declared("devices", app_json, []),
+        "privileged": return_sane_default_if_not_declared("privileged", app_json, False),
+        "rolling_restart": return_sane_default_if_not_declared("rolling_restart", app_json, False)
+    }
+    return app_params
+
+
 # used to filter the hostname & device_group reports filtering to something that MongoDB can process
 def get_param_filter(param_name, full_request, filter_param="eq", request_type=str):
     filter_param = "$" + filter_param
@@ -72,6 +104,77 @@ def get_param_filter(param_name, full_request, filter_param="eq", request_type=s
         return None
 
 
+# combine all of the reports filtering params of a request to a single MongoDB filter
+def get_reports_filters(full_request):
+    hostname = get_param_filter("hostname", full_request)
+    device_group = get_param_filter("device_group", full_request)
+    report_creation_time_filter = full_request.args.get('report_creation_time_filter', "eq", str)
+    report_creation_time = get_param_filter("report_creation_time", full_request,
+                                            filter_param=report_creation_time_filter, request_type=int)
+    updated = get_param_filter("updated", full_request, filter_param="eq", request_type=str)
+    filters = {}
+    for filter_option in [hostname, device_group, report_creation_time, updated]:
+        if filter_option is not None:
+            filters = {**filters, **filter_option}
+    return filters
+
+
+# generate the newline delimited JSON export of the reports, the lines are joined to a chunk every chunk_size reports
+# & each chunk is compressed as part of a single gzip stream (if asked to) so only one chunk is ever kept in memory
+def generate_reports_export(reports, content_encoding="identity", chunk_size=1000):
+    compressor = None
+    if content_encoding == "gzip":
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    report_lines = []
+    for report in reports:
+        report_lines.append(dumps(report) + "\n")
+        if len(report_lines) >= chunk_size:
+            export_chunk = "".join(report_lines).encode('utf-8')
+            report_lines = []
+            if compressor is not None:
+                export_chunk = compressor.compress(export_chunk)
+            if export_chunk:
+                yield export_chunk
+    export_chunk = "".join(report_lines).encode('utf-8')
+    if compressor is not None:
+        export_chunk = compressor.compress(export_chunk) + compressor.flush()
+    if export_chunk:
+        yield export_chunk
+
+
+# returns the version of a device group config, it's derived from the config version counters (as returned by
+# get_device_group_config_versions) along with the digest of the config content saved with them so it changes if & only
+# if the config does and is used as the config ETag & the key configs are cached by
+def get_config_version(device_group_versions):
+    versions_json = json.dumps(device_group_versions, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(versions_json.encode('utf-8')).hexdigest()[:32]
+
+
+# returns the ETag of a device group config version in a content encoding, each encoding of a config is a different
+# representation of it so each gets its own ETag
+def get_config_etag(device_group_version, content_encoding):
+    if content_encoding == "identity":
+        return device_group_version
+    return device_group_version + "-" + content_encoding
+
+
+# returns the device group config version of an ETag (or of a since param that was set to an ETag) without its content
+# encoding
+def get_etag_config_version(etag):
+    device_group_version, separator, content_encoding = etag.strip('"').rpartition("-")
+    if separator != "" and content_encoding in CONTENT_ENCODINGS:
+        return device_group_version
+    return etag.strip('"')
+
+
+# check if an If-None-Match header matches a device group config version in any of its content encodings
+def if_none_match_config_version(if_none_match, device_group_version):
+    if if_none_match.star_tag is True:
+        return True
+    return any(get_etag_config_version(etag) == device_group_version
+               for etag in if_none_match.as_set(include_weak=True))
+
+
 # check if a user is allowed to preform
 def check_authorized(permission_needed=None, permission_object_type=None):
     # by default don't allow access
@@ -80,9 +183,10 @@ def check_authorized(permission_needed=None, permission_object_type=None):
     # if auth is disabled or the user is a local admin always allow access
     if (auth_enabled is False) or (g.user_type == "local"):
         allow_access = True
-    # otherwise query the db for the current user permissions and set the default reply to not be allowed
+    # otherwise get the current user permissions and set the default reply to not be allowed
     else:
-        # if the user is admin allow access:
+        # if the user is admin allow access, the user permissions are compiled & kept in memory so this is usually done
+        # without querying the db
         user_permissions = mongo_connection.mongo_list_user_permissions(g.user)
         if user_permissions["admin"] is True:
             allow_access = True
@@ -93,10 +197,8 @@ def check_authorized(permission_needed=None, permission_object_type=None):
         # in any other case allow access if the permission needed is in the permission list of the user in the db
         elif permission_object_type == "apps" or permission_object_type == "device_groups" or \
                 permission_object_type == "cron_jobs":
-            for permission_key, permission_value in user_permissions[permission_object_type].items():
-                if permission_needed == {permission_key: permission_value}:
-                    allow_access = True
-                    break
+            if permission_needed.items() <= user_permissions[permission_object_type].items():
+                allow_access = True
     return allow_access
 
 
@@ -147,17 +249,174 @@ auth_enabled = parser.read_configuration_variable("auth_enabled",  default_value
 cache_time = parser.read_configuration_variable("cache_time",  default_value=10)
 cache_max_size = parser.read_configuration_variable("cache_max_size",  default_value=1024)
 mongo_max_pool_size = parser.read_configuration_variable("mongo_max_pool_size",  default_value=25)
+watch_device_group_changes = parser.read_configuration_variable("watch_device_group_changes",  default_value=True)
+long_poll_max_wait = parser.read_configuration_variable("long_poll_max_wait",  default_value=300)
+events_heartbeat_interval = parser.read_configuration_variable("events_heartbeat_interval",  default_value=15)
+auth_cache_time = parser.read_configuration_variable("auth_cache_time",  default_value=60)
+auth_cache_max_size = parser.read_configuration_variable("auth_cache_max_size",  default_value=1024)
+permissions_cache_time = parser.read_configuration_variable("permissions_cache_time",  default_value=10)
+permissions_cache_max_size = parser.read_configuration_variable("permissions_cache_max_size",  default_value=1024)
+hashing_pool_size = parser.read_configuration_variable("hashing_pool_size",  default_value=2)
+hashing_queue_size = parser.read_configuration_variable("hashing_queue_size",  default_value=64)
+session_secret = parser.read_configuration_variable("session_secret",  default_value=None)
+session_ttl = parser.read_configuration_variable("session_ttl",  default_value=900)
+cache_backend = parser.read_configuration_variable("cache_backend",  default_value="memory")
+shared_cache_path = parser.read_configuration_variable("shared_cache_path",
+                                                      default_value="/dev/shm/nebula_manager_cache")
+shared_cache_size = parser.read_configuration_variable("shared_cache_size",  default_value=33554432)
+shared_cache_slot_size = parser.read_configuration_variable("shared_cache_slot_size",  default_value=65536)
+prune_schedule_check_interval = parser.read_configuration_variable("prune_schedule_check_interval",  default_value=10)
+reports_max_time_ms = parser.read_configuration_variable("reports_max_time_ms",  default_value=10000)
+reports_export_batch_size = parser.read_configuration_variable("reports_export_batch_size",  default_value=1000)
+reports_latest_update_interval = parser.read_configuration_variable("reports_latest_update_interval",  default_value=10)
+reports_latest_batch_size = parser.read_configuration_variable("reports_latest_batch_size",  default_value=1000)
+reports_latest_overlap_time = parser.read_configuration_variable("reports_latest_overlap_time",  default_value=300)
 
 # login to db at startup
-mongo_connection = MongoConnection(mongo_url, schema_name, max_pool_size=mongo_max_pool_size)
+mongo_connection = MongoConnection(mongo_url, schema_name, max_pool_size=mongo_max_pool_size,
+                                   permissions_cache_max_size=permissions_cache_max_size,
+                                   permissions_cache_time=permissions_cache_time,
+                                   references_cache_max_size=cache_max_size, references_cache_time=cache_time)
 print("opened MongoDB connection")
 
 # ensure mongo is indexed properly
 mongo_connection.mongo_create_index("apps", "app_name")
 mongo_connection.mongo_create_index("device_groups", "device_group")
 mongo_connection.mongo_create_index("users", "user")
+mongo_connection.mongo_create_index("users", "user_name")
 mongo_connection.mongo_create_index("user_groups", "user_group")
 mongo_connection.mongo_create_index("cron_jobs", "cron_job_name")
+mongo_connection.mongo_create_token_id_index()
+mongo_connection.mongo_create_index("device_groups", "apps", unique=False)
+mongo_connection.mongo_create_index("apps", "docker_image", unique=False)
+mongo_connection.mongo_create_index("device_groups", "prune_scheduled_at", unique=False)
+mongo_connection.mongo_create_reports_indexes()
+mongo_connection.mongo_create_index("device_groups", "cron_jobs", unique=False)
+
+# recently verified user credentials are kept to avoid rechecking them against their bcrypt hash on each request
+verified_secrets_cache = VerifiedSecretsCache(max_size=auth_cache_max_size, ttl=auth_cache_time)
+
+# bcrypt hashing & checking is done on a thread pool so it won't block the gevent hub
+hashing_pool = HashingPool(pool_size=hashing_pool_size, max_queue_size=hashing_queue_size)
+
+# session tokens are signed with the session_secret, if it's not configured a random one is used which means sessions
+# are only valid on the manager process that created them
+if session_secret is None:
+    session_key = secrets.token_bytes(32)
+else:
+    session_key = str(session_secret).encode('utf-8')
+
+# the version of each device group config is kept for cache_time seconds while the configs themselves are kept by their
+# version (in each of the CONTENT_ENCODINGS) as a config of a given version never changes, with the shared_memory
+# cache_backend both are kept in memory mapped files under shared_cache_path which all the gunicorn workers on the host
+# share, configs too large for a shared_cache_slot_size slot are kept in the memory of each worker instead
+if cache_backend == "memory":
+    device_group_versions_cache = MemoryCache(max_size=cache_max_size)
+    device_group_configs_cache = MemoryCache(max_size=cache_max_size * len(CONTENT_ENCODINGS))
+elif cache_backend == "shared_memory":
+    try:
+        device_group_versions_cache = SharedMemoryCache(shared_cache_path + "_versions", cache_max_size * 512,
+                                                        slot_size=512)
+        device_group_configs_cache = SharedMemoryCache(shared_cache_path + "_configs", shared_cache_size,
+                                                       slot_size=shared_cache_slot_size,
+                                                       overflow_max_size=cache_max_size * len(CONTENT_ENCODINGS))
+    except OSError as e:
+        print("unable to open the shared memory cache at " + shared_cache_path, file=sys.stderr)
+        print(e, file=sys.stderr)
+        os._exit(2)
+else:
+    print("cache_backend must be either memory or shared_memory", file=sys.stderr)
+    os._exit(2)
+
+# requests waiting for a device group config to change are woken through it
+device_group_notifier = ChangeNotifier()
+
+# the app rollouts still in progress are kept in memory for cache_time seconds or until an app rollout changes
+active_app_rollouts_cache = TTLCache(maxsize=1, ttl=cache_time)
+active_app_rollouts_cache_lock = threading.Lock()
+
+
+# evict a device group (or all of them if None is given) from the cache so the next request for it reads its current
+# config version & wake all the requests waiting for it to change
+def invalidate_device_group_cache(device_group):
+    if device_group is None:
+        device_group_versions_cache.clear()
+    else:
+        device_group_versions_cache.delete(device_group)
+    device_group_notifier.notify(device_group)
+
+
+# evict the app rollouts still in progress from the cache so the next request reads them again
+def invalidate_active_app_rollouts_cache(app_name=None):
+    with active_app_rollouts_cache_lock:
+        active_app_rollouts_cache.clear()
+
+
+# a device group changed by another manager can change which device groups use each app & cron job
+def on_watched_device_group_change(device_group):
+    mongo_connection.mongo_invalidate_device_group_references()
+
+
+# watch for changes made by any manager to a collection & call on_change with each of them as they happen, if change
+# streams are not available (like on a standalone mongod) the caches of the collection fall back to expiring entries
+# after cache_time seconds
+def watch_collection_changes(collection_name, on_change):
+    while True:
+        try:
+            mongo_connection.mongo_watch_collection(collection_name, on_change)
+        except OperationFailure as e:
+            print("unable to watch " + collection_name + " changes - their cached data will expire after cache_time",
+                  file=sys.stderr)
+            print(e, file=sys.stderr)
+            return
+        except PyMongoError as e:
+            print(collection_name + " changes watch failed - retrying", file=sys.stderr)
+            print(e, file=sys.stderr)
+            time.sleep(5)
+
+
+# changes made by this manager evict the caches right away, changes made by others are evicted by watching for them,
+# device group configs are rebuilt on every app & cron job change so only changes to the device groups themselves drop
+# the map of the device groups that use each app & cron job
+mongo_connection.device_group_config_listeners.append(invalidate_device_group_cache)
+mongo_connection.app_rollouts_listeners.append(invalidate_active_app_rollouts_cache)
+if watch_device_group_changes is True:
+    for watched_collection_name, on_watched_change in [("device_group_configs", invalidate_device_group_cache),
+                                                       ("device_groups", on_watched_device_group_change),
+                                                       ("app_rollouts", invalidate_active_app_rollouts_cache)]:
+        threading.Thread(target=watch_collection_changes, args=(watched_collection_name, on_watched_change),
+                         daemon=True).start()
+
+# increase the prune_id of the device groups whose staggered prune is due, this is checked every
+# prune_schedule_check_interval seconds
+def run_scheduled_prunes():
+    while True:
+        time.sleep(prune_schedule_check_interval)
+        try:
+            mongo_connection.mongo_run_scheduled_prunes()
+        except PyMongoError as e:
+            print("running scheduled prunes failed - retrying", file=sys.stderr)
+            print(e, file=sys.stderr)
+
+
+threading.Thread(target=run_scheduled_prunes, daemon=True).start()
+
+
+# keep the latest report of each hostname up to date, the first run seeds it from all the reports & each run after
+# applies the reports added since the previous one (once every reports_latest_overlap_time seconds along with the ones
+# before it to catch reports inserted late), this is checked every reports_latest_update_interval seconds
+def update_latest_reports():
+    while True:
+        try:
+            mongo_connection.mongo_update_latest_reports(batch_size=reports_latest_batch_size,
+                                                         overlap_time=reports_latest_overlap_time)
+        except PyMongoError as e:
+            print("updating latest reports failed - retrying", file=sys.stderr)
+            print(e, file=sys.stderr)
+        time.sleep(reports_latest_update_interval)
+
+
+threading.Thread(target=update_latest_reports, daemon=True).start()
 
 # get current list of apps at startup
 nebula_apps = mongo_connection.mongo_list_apps()
@@ -188,10 +447,21 @@ def verify_password(username, password):
         g.user = username
         g.user_type = "local"
         return True
+    # the permissions version is read before checking the DB so a user changed while checking isn't remembered as
+    # verified at the version after the change
+    permissions_version = mongo_connection.mongo_get_permissions_version()
+    # if the user and password were recently verified against the DB & no user was changed since allow access
+    if verified_secrets_cache.get_verified_user("password", password, login_name=username,
+                                                permissions_version=permissions_version) is not None:
+        g.user = username
+        g.user_type = "db"
+        return True
     # else if the user and password matches any in the DB allow access
     elif mongo_connection.mongo_check_user_exists(username) is True:
         user_exists, user_json = mongo_connection.mongo_get_user(username)
-        if check_secret_matches(password, user_json["password"]) is True:
+        if hashing_pool.check_secret_matches(password, user_json["password"]) is True:
+            verified_secrets_cache.add_verified_secret("password", password, username, login_name=username,
+                                                       permissions_version=permissions_version)
             g.user = username
             g.user_type = "db"
             return True
@@ -212,17 +482,49 @@ def verify_token(token):
     elif auth_token == token:
         g.user_type = "local"
         return True
-    # else if the token matches any in the DB allow access or deny access if not
-    else:
-        allow_access = False
-        user_list = mongo_connection.mongo_list_users()
-        for user in user_list:
-            user_exists, user_json = mongo_connection.mongo_get_user(user)
-            if check_secret_matches(token, user_json["token"]) is True:
-                g.user = user
+    # else if it's a session token allow access if it's signed by us, not expired & the permissions didn't change since
+    # it was created
+    elif token.startswith(SESSION_TOKEN_PREFIX):
+        session = read_session_token(session_key, token)
+        if session is None:
+            return False
+        if session["permissions_version"] != mongo_connection.mongo_get_permissions_version():
+            return False
+        g.user = session["user_name"]
+        g.user_type = "db"
+        return True
+    # else if the token was recently verified against the DB & no user was changed since allow access
+    permissions_version = mongo_connection.mongo_get_permissions_version()
+    cached_user_name = verified_secrets_cache.get_verified_user("token", token, permissions_version=permissions_version)
+    if cached_user_name is not None:
+        g.user = cached_user_name
+        g.user_type = "db"
+        return True
+    # else if the token has a token_id only the user it belongs to needs to be checked
+    token_id = get_token_id(token)
+    if token_id is not None:
+        user_exists, user_json = mongo_connection.mongo_get_user_by_token_id(token_id)
+        if user_exists is True:
+            if hashing_pool.check_secret_matches(token, user_json["token"]) is True:
+                verified_secrets_cache.add_verified_secret("token", token, user_json["user_name"],
+                                                           permissions_version=permissions_version)
+                g.user = user_json["user_name"]
                 g.user_type = "db"
-                allow_access = True
-        return allow_access
+                return True
+            else:
+                return False
+    # else it's a legacy token so allow access if it matches any of the users that still use a legacy token, refreshing
+    # the user token will replace it with a token that has a token_id
+    allow_access = False
+    for user_json in mongo_connection.mongo_list_legacy_token_users():
+        if hashing_pool.check_secret_matches(token, user_json["token"]) is True:
+            verified_secrets_cache.add_verified_secret("token", token, user_json["user_name"],
+                                                       permissions_version=permissions_version)
+            g.user = user_json["user_name"]
+            g.user_type = "db"
+            allow_access = True
+            break
+    return allow_access
 
 
 # api check page - return 200 and a massage just so we know API is reachable
@@ -233,6 +535,41 @@ def check_page():
     return jsonify({"api_available": True}), 200
 
 
+# create a short lived session token for the current user which can then be used as a Bearer token until it expires
+@app.route('/api/' + API_VERSION + '/auth/session', methods=["POST"])
+@multi_auth.login_required
+def create_session():
+    # sessions are only for DB users, the local user credentials are checked without bcrypt so don't need them
+    if auth_enabled is False or g.user_type != "db":
+        return jsonify({"session_supported": False}), 403
+    permissions_version = mongo_connection.mongo_get_permissions_version()
+    session_token = create_session_token(session_key, g.user, permissions_version, session_ttl)
+    return jsonify({"token": session_token, "expires_in": session_ttl}), 200
+
+
+# get the hashing pool counters
+@app.route('/api/' + API_VERSION + '/status/hashing', methods=["GET"])
+@multi_auth.login_required
+@check_authorization_wrapper(permission_needed="ro", permission_object_type="admin")
+def get_hashing_status():
+    return jsonify(hashing_pool.get_stats()), 200
+
+
+# get the device group configs cache counters
+@app.route('/api/' + API_VERSION + '/status/cache', methods=["GET"])
+@multi_auth.login_required
+@check_authorization_wrapper(permission_needed="ro", permission_object_type="admin")
+def get_cache_status():
+    cache_stats = {"cache_backend": cache_backend, "device_group_configs": device_group_configs_cache.get_stats()}
+    return jsonify(cache_stats), 200
+
+
+# reply that the server is too busy when there are more secrets waiting to be hashed\checked then the queue allows
+@app.errorhandler(HashingQueueFull)
+def hashing_queue_full(error):
+    return jsonify({"hashing_queue_full": True}), 503
+
+
 # create a new app
 @app.route('/api/' + API_VERSION + '/apps/<app_name>', methods=["POST"])
 @multi_auth.login_required
@@ -249,25 +586,15 @@ def create_app(app_name):
         except:
             return json.dumps(find_missing_params({}, ["docker_image"])), 400
         try:
-            starting_ports = return_sane_default_if_not_declared("starting_ports", app_json, [])
-            containers_per = return_sane_default_if_not_declared("containers_per", app_json, {"server": 1})
-            env_vars = return_sane_default_if_not_declared("env_vars", app_json, {})
-            docker_image = app_json["docker_image"]
-            running = return_sane_default_if_not_declared("running", app_json, True)
-            networks = return_sane_default_if_not_declared("networks", app_json, ["nebula", "bridge"])
-            volumes = return_sane_default_if_not_declared("volumes", app_json, [])
-            devices = return_sane_default_if_not_declared("devices", app_json, [])
-            privileged = return_sane_default_if_not_declared("privileged", app_json, False)
-            rolling_restart = return_sane_default_if_not_declared("rolling_restart", app_json, False)
+            app_params = get_app_params(app_json, {})
         except:
             return json.dumps(find_missing_params(app_json, ["docker_image"])), 400
         # check edge case of port being outside of possible port ranges
-        ports_check_return_message, port_check_return_code = check_ports_valid_range(starting_ports)
+        ports_check_return_message, port_check_return_code = check_ports_valid_range(app_params["starting_ports"])
         if port_check_return_code >= 300:
             return ports_check_return_message, port_check_return_code
         # update the db
-        app_json = mongo_connection.mongo_add_app(app_name, starting_ports, containers_per, env_vars, docker_image,
-                                                  running, networks, volumes, devices, privileged, rolling_restart)
+        app_json = mongo_connection.mongo_add_app(app_name, **app_params)
         return dumps(app_json), 200
 
 
@@ -345,25 +672,15 @@ def update_app(app_name):
     except:
         return json.dumps(find_missing_params({}, ["docker_image"])), 400
     try:
-        starting_ports = return_sane_default_if_not_declared("starting_ports", app_json, [])
-        containers_per = return_sane_default_if_not_declared("containers_per", app_json, {"server": 1})
-        env_vars = return_sane_default_if_not_declared("env_vars", app_json, [])
-        docker_image = app_json["docker_image"]
-        running = return_sane_default_if_not_declared("running", app_json, True)
-        networks = return_sane_default_if_not_declared("networks", app_json, ["nebula", "bridge"])
-        volumes = return_sane_default_if_not_declared("volumes", app_json, [])
-        devices = return_sane_default_if_not_declared("devices", app_json, [])
-        privileged = return_sane_default_if_not_declared("privileged", app_json, False)
-        rolling_restart = return_sane_default_if_not_declared("rolling_restart", app_json, False)
+        app_params = get_app_params(app_json, [])
     except:
         return json.dumps(find_missing_params(app_json, ["docker_image"])), 400
     # check edge case of port being outside of possible port ranges
-    ports_check_return_message, port_check_return_code = check_ports_valid_range(starting_ports)
+    ports_check_return_message, port_check_return_code = check_ports_valid_range(app_params["starting_ports"])
     if port_check_return_code >= 300:
         return ports_check_return_message, port_check_return_code
     # update db
-    app_json = mongo_connection.mongo_update_app(app_name, starting_ports, containers_per, env_vars, docker_image,
-                                                 running, networks, volumes, devices, privileged, rolling_restart)
+    app_json = mongo_connection.mongo_update_app(app_name, **app_params)
     return dumps(app_json), 202
 
 
@@ -396,13 +713,229 @@ def update_app_fields(app_name):
     return dumps(app_json), 202
 
 
+# check a single operation of a bulk apps request the same way its matching single app route does, app_states has the
+# running state of each existing app the request names & bulk_app_names the names already used by its earlier
+# operations, returns the operation result along with the operation to apply or None if it's not valid
+def check_bulk_app_operation(operation, app_states, bulk_app_names):
+    if not isinstance(operation, dict) or not isinstance(operation.get("app_name"), str) or \
+            operation.get("op") not in ["create", "update", "patch", "start", "stop", "restart"]:
+        return {"status": 400, "missing_parameters": True}, None
+    operation_type = operation["op"]
+    app_name = operation["app_name"]
+    operation_result = {"op": operation_type, "app_name": app_name}
+    if check_authorized(permission_needed={app_name: "rw"}, permission_object_type="apps") is False:
+        return {**operation_result, "status": 403, "access_allowed": False}, None
+    if app_name in bulk_app_names:
+        return {**operation_result, "status": 400, "app_name_repeated": True}, None
+    bulk_app_names.add(app_name)
+    if operation_type == "create" and app_name in app_states:
+        return {**operation_result, "status": 403, "app_exists": True}, None
+    if operation_type != "create" and app_name not in app_states:
+        return {**operation_result, "status": 403, "app_exists": False}, None
+    if operation_type == "restart" and app_states[app_name]["running"] is False:
+        return {**operation_result, "status": 403, "running_before_restart": False}, None
+    app_params = None
+    if operation_type == "create" or operation_type == "update":
+        app_json = operation.get("params")
+        if not isinstance(app_json, dict):
+            app_json = {}
+        if "docker_image" not in app_json:
+            return {**operation_result, "status": 400, **find_missing_params(app_json, ["docker_image"])}, None
+        app_params = get_app_params(app_json, {} if operation_type == "create" else [])
+    elif operation_type == "patch":
+        app_params = operation.get("params")
+        if not isinstance(app_params, dict) or len(app_params) == 0:
+            return {**operation_result, "status": 400, "missing_parameters": True}, None
+    if app_params is not None and "starting_ports" in app_params:
+        try:
+            ports_check_return_message, port_check_return_code = check_ports_valid_range(app_params["starting_ports"])
+        except TypeError:
+            ports_check_return_message, port_check_return_code = json.dumps({"starting_ports": "invalid port"}), 400
+        if port_check_return_code >= 300:
+            return {**operation_result, "status": port_check_return_code,
+                    **json.loads(ports_check_return_message)}, None
+    return operation_result, (operation_type, app_name, app_params)
+
+
+# apply many app operations in a single request, the body is a list of operations each with an op (create, update,
+# patch, start, stop or restart), the app_name & for create, update & patch the params the matching single app route
+# takes as its body, all the operations are checked first & the valid ones are then applied together with a single
+# unordered bulk write, the reply has the result of each operation in the order they were given
+@app.route('/api/' + API_VERSION + '/apps/_bulk', methods=["POST"])
+@multi_auth.login_required
+def bulk_update_apps():
+    try:
+        operations = request.json
+    except:
+        return jsonify({"missing_parameters": True}), 400
+    if type(operations) is not list or len(operations) == 0:
+        return jsonify({"missing_parameters": True}), 400
+    app_names = [operation["app_name"] for operation in operations
+                 if isinstance(operation, dict) and isinstance(operation.get("app_name"), str)]
+    app_states = {}
+    for app_state in mongo_connection.mongo_iterate_documents("apps", "app_name", names=app_names, fields=["running"]):
+        app_states[app_state["app_name"]] = app_state
+    operations_results = []
+    app_operations = []
+    app_operations_results = []
+    bulk_app_names = set()
+    for operation in operations:
+        operation_result, app_operation = check_bulk_app_operation(operation, app_states, bulk_app_names)
+        operations_results.append(operation_result)
+        if app_operation is not None:
+            app_operations.append(app_operation)
+            app_operations_results.append(operation_result)
+    if len(app_operations) > 0:
+        operation_errors = mongo_connection.mongo_bulk_update_apps(app_operations)
+        app_ids = {}
+        for app_id in mongo_connection.mongo_iterate_documents("apps", "app_name", fields=["app_id"],
+                                                               names=[app_name for ignored, app_name, ignored_params
+                                                                      in app_operations]):
+            app_ids[app_id["app_name"]] = app_id["app_id"]
+        for index, operation_result in enumerate(app_operations_results):
+            if index in operation_errors:
+                operation_result["status"] = 500
+                operation_result["error"] = operation_errors[index]
+            else:
+                operation_result["status"] = 200 if operation_result["op"] == "create" else 202
+                operation_result["app_id"] = app_ids.get(operation_result["app_name"])
+    return dumps({"results": operations_results}), 200
+
+
+# get the app selector of a request body, a selector picks apps by any mix of a docker_image_prefix, the device_groups
+# that use them & an app_name_pattern regex, returns None if the selector is missing or invalid
+def get_app_selector(request_json):
+    if not isinstance(request_json, dict) or not isinstance(request_json.get("selector"), dict):
+        return None
+    app_selector = request_json["selector"]
+    if len(app_selector) == 0 or \
+            not set(app_selector.keys()) <= {"docker_image_prefix", "device_groups", "app_name_pattern"}:
+        return None
+    if not isinstance(app_selector.get("docker_image_prefix", ""), str) or \
+            not isinstance(app_selector.get("app_name_pattern", ""), str):
+        return None
+    if "device_groups" in app_selector and (not isinstance(app_selector["device_groups"], list) or
+                                            not all(isinstance(device_group, str)
+                                                    for device_group in app_selector["device_groups"])):
+        return None
+    try:
+        re.compile(app_selector.get("app_name_pattern", ""))
+    except re.error:
+        return None
+    return app_selector
+
+
+# set the fields given in params on all the apps a selector matches with a single update (see get_app_selector), each
+# updated app has its app_id increased & the reply has the new app_id of each of them by its name, users that are not
+# admins only update the apps they have rw permissions on
+@app.route('/api/' + API_VERSION + '/apps/_selector/update', methods=["POST"])
+@multi_auth.login_required
+def update_selected_apps():
+    try:
+        request_json = request.json
+    except:
+        return jsonify({"missing_parameters": True}), 400
+    app_selector = get_app_selector(request_json)
+    if app_selector is None:
+        return jsonify({"selector_valid": False}), 400
+    update_fields_dict = request_json.get("params")
+    if not isinstance(update_fields_dict, dict) or len(update_fields_dict) == 0:
+        return jsonify({"missing_parameters": True}), 400
+    if not set(update_fields_dict.keys()).isdisjoint({"_id", "app_id", "app_name"}):
+        return jsonify({"params_valid": False}), 400
+    if "starting_ports" in update_fields_dict:
+        try:
+            ports_check_return_message, port_check_return_code = \
+                check_ports_valid_range(update_fields_dict["starting_ports"])
+        except TypeError:
+            return jsonify({"starting_ports": "invalid port"}), 400
+        if port_check_return_code >= 300:
+            return ports_check_return_message, port_check_return_code
+    app_ids = mongo_connection.mongo_update_selected_apps(app_selector, update_fields_dict,
+                                                          allowed_app_names=get_allowed_names("apps", "rw"))
+    return jsonify({"apps": app_ids}), 202
+
+
+# restart all the running apps a selector matches with a single update (see get_app_selector), the reply has the new
+# app_id of each restarted app by its name, users that are not admins only restart the apps they have rw permissions on
+@app.route('/api/' + API_VERSION + '/apps/_selector/restart', methods=["POST"])
+@multi_auth.login_required
+def restart_selected_apps():
+    try:
+        request_json = request.json
+    except:
+        return jsonify({"missing_parameters": True}), 400
+    app_selector = get_app_selector(request_json)
+    if app_selector is None:
+        return jsonify({"selector_valid": False}), 400
+    app_ids = mongo_connection.mongo_update_selected_apps(app_selector,
+                                                          allowed_app_names=get_allowed_names("apps", "rw"),
+                                                          running_only=True)
+    return jsonify({"apps": app_ids}), 202
+
+
+# get the names of the apps, device_groups or cron_jobs the current user has the permission_needed on or None if the
+# user has it on all of them
+def get_allowed_names(permission_object_type, permission_needed="ro"):
+    if (auth_enabled is False) or (g.user_type == "local"):
+        return None
+    user_permissions = mongo_connection.mongo_list_user_permissions(g.user)
+    if user_permissions["admin"] is True:
+        return None
+    return [name for name, permission in user_permissions[permission_object_type].items()
+            if permission == permission_needed]
+
+
+# split a list request param given as comma separated values (or repeated) to a list or None if it's not given
+def get_list_request_param(param_name):
+    param_values = []
+    for param_value in request.args.getlist(param_name):
+        param_values.extend([value for value in param_value.split(",") if value != ""])
+    if len(param_values) == 0:
+        return None
+    return param_values
+
+
+# list the names of a collection in pages sorted by name, limit is the page size (all the names are listed if it's not
+# given) & after is the last name of the previous page, when there might be more names to list the reply has the after
+# to pass to get the next page, passing expand=true lists the full documents (or only their fields given in fields) of
+# the page instead with names limiting them to the given names, documents the user isn't allowed to read are filtered
+# out by the query itself
+def list_names_page(list_function, list_key, collection_name=None, name_field=None, permission_object_type=None):
+    limit = request.args.get('limit', 0, int)
+    after = request.args.get('after')
+    if limit < 0:
+        return jsonify({"limit_valid": False}), 400
+    if collection_name is None or request.args.get('expand', 'false').lower() != 'true':
+        names_list = list_function(limit=limit, after=after)
+        reply = {list_key: names_list}
+        if limit > 0 and len(names_list) == limit:
+            reply["after"] = names_list[-1]
+        return jsonify(reply), 200
+    names = get_list_request_param("names")
+    if permission_object_type == "admin":
+        if check_authorized(permission_needed={"admin": "ro"}, permission_object_type="admin") is False:
+            return jsonify({"access_allowed": False}), 403
+    else:
+        readable_names = get_allowed_names(permission_object_type)
+        if readable_names is not None:
+            names = readable_names if names is None else [name for name in names if name in readable_names]
+    documents_list = list(mongo_connection.mongo_iterate_documents(collection_name, name_field, limit=limit,
+                                                                   after=after, names=names,
+                                                                   fields=get_list_request_param("fields")))
+    reply = {list_key: documents_list}
+    if limit > 0 and len(documents_list) == limit:
+        reply["after"] = documents_list[-1][name_field]
+    return dumps(reply), 200
+
+
 # list apps
 @app.route('/api/' + API_VERSION + '/apps', methods=["GET"])
 @retry(stop_max_attempt_number=3, wait_exponential_multiplier=200, wait_exponential_max=500)
 @multi_auth.login_required
 def list_apps():
-    nebula_apps_list = mongo_connection.mongo_list_apps()
-    return jsonify({"apps": nebula_apps_list}), 200
+    return list_names_page(mongo_connection.mongo_list_apps, "apps", collection_name="apps",
+                           name_field="app_name", permission_object_type="apps")
 
 
 # get app info
@@ -418,29 +951,259 @@ def get_app(app_name):
         return jsonify({"app_exists": False}), 403
 
 
-# get device_group info
+# set the rollout policy of an app, while the app has rolling_restart set each of its changes is given to another
+# batch_percent of the devices every interval seconds while the rest of the devices keep getting its previous version
+@app.route('/api/' + API_VERSION + '/apps/<app_name>/rollout', methods=["PUT"])
+@multi_auth.login_required
+@check_authorization_wrapper(permission_needed="rw", permission_object_type="apps")
+def set_app_rollout(app_name):
+    try:
+        rollout_json = request.json
+        batch_percent = rollout_json["batch_percent"]
+        interval = rollout_json["interval"]
+    except:
+        return json.dumps(find_missing_params({}, ["batch_percent", "interval"])), 400
+    if not isinstance(batch_percent, int) or not 1 <= batch_percent <= 100:
+        return jsonify({"batch_percent": "must be an integer between 1 and 100"}), 400
+    if not isinstance(interval, (int, float)) or interval <= 0:
+        return jsonify({"interval": "must be a positive number of seconds"}), 400
+    app_exists, app_rollout = mongo_connection.mongo_set_app_rollout_policy(app_name, batch_percent, interval)
+    if app_exists is False:
+        return jsonify({"app_exists": False}), 403
+    return jsonify(get_rollout_progress(app_rollout, time.time())), 202
+
+
+# get the rollout policy of an app & the progress of its latest rollout
+@app.route('/api/' + API_VERSION + '/apps/<app_name>/rollout', methods=["GET"])
+@retry(stop_max_attempt_number=3, wait_exponential_multiplier=200, wait_exponential_max=500)
+@multi_auth.login_required
+@check_authorization_wrapper(permission_needed="ro", permission_object_type="apps")
+def get_app_rollout(app_name):
+    app_rollout_exists, app_rollout = mongo_connection.mongo_get_app_rollout(app_name)
+    if app_rollout_exists is False:
+        return jsonify({"app_rollout_exists": False}), 403
+    return jsonify(get_rollout_progress(app_rollout, time.time())), 200
+
+
+# remove the rollout policy of an app so its following changes are given to all the devices at once
+@app.route('/api/' + API_VERSION + '/apps/<app_name>/rollout', methods=["DELETE"])
+@multi_auth.login_required
+@check_authorization_wrapper(permission_needed="rw", permission_object_type="apps")
+def delete_app_rollout(app_name):
+    result = mongo_connection.mongo_remove_app_rollout_policy(app_name)
+    if result.deleted_count == 0:
+        return jsonify({"app_rollout_exists": False}), 403
+    return "{}", 200
+
+
+# list the device groups that use an app
+@app.route('/api/' + API_VERSION + '/apps/<app_name>/device_groups', methods=["GET"])
+@retry(stop_max_attempt_number=3, wait_exponential_multiplier=200, wait_exponential_max=500)
+@multi_auth.login_required
+@check_authorization_wrapper(permission_needed="ro", permission_object_type="apps")
+def list_app_device_groups(app_name):
+    device_groups = mongo_connection.mongo_list_cached_device_group_references("apps", app_name)
+    return jsonify({"device_groups": device_groups}), 200
+
+
+# get the app rollouts still in progress by their app name
+@cached(cache=active_app_rollouts_cache, lock=active_app_rollouts_cache_lock)
+def get_active_app_rollouts():
+    return mongo_connection.mongo_list_active_app_rollouts()
+
+
+# get the previous version of each app of a device group that is being rolled out & a device is not yet in the rollout
+# waves of by the app name
+def get_held_back_apps(device_group, device):
+    held_back_apps = {}
+    for app_name, app_rollout in get_active_app_rollouts().items():
+        if is_device_in_rollout_wave(app_rollout, device, time.time()) is False and \
+                device_group in mongo_connection.mongo_list_cached_device_group_references("apps", app_name):
+            held_back_apps[app_name] = app_rollout["previous_app"]
+    return held_back_apps
+
+
+# get the current version of a device group config or None if the device group doesn't exist, the version is cached for
+# cache_time seconds with an empty value standing for a device group that doesn't exist, when the device asking is given
+# the version is the one of the config it gets with the apps it's not yet in the rollout waves of at their previous
+# version
+def get_device_group_version(device_group, device=None):
+    device_group_version = device_group_versions_cache.get(device_group)
+    if device_group_version is not None:
+        device_group_version = bytes(device_group_version).decode('utf-8') or None
+    else:
+        device_group_exists, device_group_versions = mongo_connection.mongo_get_device_group_versions(device_group)
+        if device_group_exists is False:
+            device_group_version = None
+        else:
+            device_group_version = get_config_version(device_group_versions)
+        device_group_versions_cache.set(device_group, (device_group_version or "").encode('utf-8'), ttl=cache_time)
+    if device is None or device_group_version is None:
+        return device_group_version
+    held_back_apps = get_held_back_apps(device_group, device)
+    if len(held_back_apps) == 0:
+        return device_group_version
+    device_group_exists, device_group_versions = mongo_connection.mongo_get_device_group_versions(device_group)
+    if device_group_exists is False:
+        return None
+    ignored, device_group_versions = apply_held_back_apps({"apps": []}, device_group_versions, held_back_apps)
+    return get_config_version(device_group_versions)
+
+
+# get a device group config serialized (as bytes) in a content encoding along with its version, configs are cached in
+# all the CONTENT_ENCODINGS by their version (which includes the config content digest) so a cached config never goes
+# stale, even when its counters restart after an app or a device group is created again, & is compressed only once, on
+# a cache miss the version returned is the one of the config read from the db which can be newer then the one asked
+# for, returns None, None if the device group doesn't exist, when the device asking is given the apps it's not yet in
+# the rollout waves of are at their previous version (which is part of the config version so it's cached the same way)
+def get_device_group_config(device_group, device_group_version, content_encoding="identity", device=None):
+    device_group_config_body = device_group_configs_cache.get(device_group + "/" + device_group_version + "/" +
+                                                              content_encoding)
+    if device_group_config_body is not None:
+        return device_group_version, device_group_config_body
+    device_group_exists, device_group_versions, device_group_config_json = \
+        mongo_connection.mongo_get_device_group_config_json(device_group)
+    if device_group_exists is False:
+        return None, None
+    held_back_apps = get_held_back_apps(device_group, device) if device is not None else {}
+    if len(held_back_apps) > 0:
+        device_group_config, device_group_versions = apply_held_back_apps(json.loads(device_group_config_json),
+                                                                          device_group_versions, held_back_apps)
+        device_group_config_json = dumps(device_group_config)
+    device_group_version = get_config_version(device_group_versions)
+    device_group_config_bodies = encode_content(device_group_config_json.encode('utf-8'))
+    for encoding, device_group_config_body in device_group_config_bodies.items():
+        device_group_configs_cache.set(device_group + "/" + device_group_version + "/" + encoding,
+                                       device_group_config_body)
+    return device_group_version, device_group_config_bodies[content_encoding]
+
+
+# wait up to wait seconds for the version of a device group config to be different then since & return its version, the
+# wait is woken as soon as a change to the device group is seen & otherwise rechecks the version every cache_time
+# seconds to catch changes made by other managers when their changes can't be watched
+def wait_for_device_group_version_change(device_group, since, wait, device=None):
+    deadline = time.monotonic() + wait
+    with device_group_notifier.listen(device_group) as change_event:
+        device_group_version = get_device_group_version(device_group, device)
+        while device_group_version == since:
+            remaining_wait = deadline - time.monotonic()
+            if remaining_wait <= 0:
+                break
+            change_event.wait(min(remaining_wait, cache_time))
+            change_event.clear()
+            device_group_version = get_device_group_version(device_group, device)
+    return device_group_version
+
+
+# get device_group info, the config version is returned as the ETag so clients that already have the current config can
+# use If-None-Match to get an empty 304 reply instead, clients can also pass the version they have as since along with a
+# wait of up to long_poll_max_wait seconds to have the reply held until the config changes (or get a 304 if it doesn't),
+# the config is sent already compressed in the encoding the client prefers out of the ones its Accept-Encoding allows
+# with the encoding added to the ETag of compressed configs (it's ignored when matching If-None-Match & since),
+# since can also be the version_vector (JSON of the device_group_id, prune_id, app_id of each app & cron_job_id of each
+# cron job) of the config the client has in which case only the apps & cron jobs changed since are returned, devices
+# should pass their name as device so apps being rolled out in waves are only given to them (in either the full config
+# or the changes) once they are in the waves
 @app.route('/api/' + API_VERSION + '/device_groups/<device_group>/info', methods=["GET"])
-@cached(cache=TTLCache(maxsize=cache_max_size, ttl=cache_time))
 @retry(stop_max_attempt_number=3, wait_exponential_multiplier=200, wait_exponential_max=500)
 @multi_auth.login_required
 @check_authorization_wrapper(permission_needed="ro", permission_object_type="device_groups")
 def get_device_group_info(device_group):
-    device_group_exists, device_group_json = mongo_connection.mongo_get_device_group(device_group)
-    if device_group_exists is False:
+    since = request.args.get('since')
+    wait = request.args.get('wait', 0, int)
+    device = request.args.get('device')
+    since_versions = None
+    if since is not None and since.startswith("{"):
+        try:
+            since_versions = json.loads(since)
+        except ValueError:
+            since_versions = None
+        if not isinstance(since_versions, dict):
+            return jsonify({"since_valid": False}), 400
+        since = get_config_version(since_versions)
+    elif since is not None:
+        since = get_etag_config_version(since)
+    content_encoding = request.accept_encodings.best_match(CONTENT_ENCODINGS, default="identity")
+    if since is not None and wait > 0:
+        device_group_version = wait_for_device_group_version_change(device_group, since,
+                                                                    min(wait, long_poll_max_wait), device)
+        if device_group_version == since:
+            response = make_response("", 304)
+            response.set_etag(get_config_etag(device_group_version, content_encoding))
+            response.vary.add("Accept-Encoding")
+            return response
+    else:
+        device_group_version = get_device_group_version(device_group, device)
+    if device_group_version is None:
+        return jsonify({"device_group_exists": False}), 403
+    if if_none_match_config_version(request.if_none_match, device_group_version) or \
+            (since_versions is not None and device_group_version == since):
+        response = make_response("", 304)
+        response.set_etag(get_config_etag(device_group_version, content_encoding))
+        response.vary.add("Accept-Encoding")
+        return response
+    if since_versions is not None:
+        held_back_apps = get_held_back_apps(device_group, device) if device is not None else {}
+        device_group_exists, device_group_config_delta = \
+            mongo_connection.mongo_get_device_group_config_delta(device_group, since_versions, held_back_apps)
+        if device_group_exists is False:
+            return jsonify({"device_group_exists": False}), 403
+        return dumps(device_group_config_delta), 200
+    device_group_version, device_group_config_body = get_device_group_config(device_group, device_group_version,
+                                                                             content_encoding, device)
+    if device_group_version is None:
         return jsonify({"device_group_exists": False}), 403
-    device_group_config = {"apps": [], "apps_list": [], "prune_id": device_group_json["prune_id"], "cron_jobs": [],
-                           "cron_jobs_list": [], "device_group_id": device_group_json["device_group_id"]}
-    for device_app in device_group_json["apps"]:
-        app_exists, app_json = mongo_connection.mongo_get_app(device_app)
-        if app_exists is True:
-            device_group_config["apps"].append(app_json)
-            device_group_config["apps_list"].append(app_json["app_name"])
-    for device_cron_job in device_group_json["cron_jobs"]:
-        cron_job_exists, cron_job_json = mongo_connection.mongo_get_cron_job(device_cron_job)
-        if cron_job_exists is True:
-            device_group_config["cron_jobs"].append(cron_job_json)
-            device_group_config["cron_jobs_list"].append(cron_job_json["cron_job_name"])
-    return dumps(device_group_config), 200
+    response = make_response(device_group_config_body, 200)
+    response.set_etag(get_config_etag(device_group_version, content_encoding))
+    response.vary.add("Accept-Encoding")
+    if content_encoding != "identity":
+        response.content_encoding = content_encoding
+    return response
+
+
+# generate the Server-Sent Events of a device group config changes, an event is sent whenever the config version is
+# different then the last one sent (or since for the first event) & a heartbeat comment is sent every
+# events_heartbeat_interval seconds without a change so idle connections are kept open
+def generate_device_group_events(device_group, since, full_config, device=None):
+    yield "retry: 5000\n\n"
+    while True:
+        device_group_version = wait_for_device_group_version_change(device_group, since, events_heartbeat_interval,
+                                                                    device)
+        if device_group_version is None:
+            yield "event: deleted\ndata: {\"device_group_exists\": false}\n\n"
+            return
+        if device_group_version == since:
+            yield ": heartbeat\n\n"
+            continue
+        if full_config is True:
+            device_group_version, event_data = get_device_group_config(device_group, device_group_version,
+                                                                       device=device)
+            if device_group_version is None:
+                continue
+            event_data = bytes(event_data).decode('utf-8')
+        else:
+            event_data = json.dumps({"device_group": device_group, "version": device_group_version})
+        yield "id: " + device_group_version + "\nevent: config\ndata: " + event_data + "\n\n"
+        since = device_group_version
+
+
+# stream the changes of a device_group config as Server-Sent Events, each event id is the config version so reconnecting
+# clients get an event only if the config changed since the Last-Event-ID (or since param) they pass, by default events
+# only carry the new config version while passing full=true makes them carry the full new config instead, devices
+# should pass their name as device the same way they do to get the device group info
+@app.route('/api/' + API_VERSION + '/device_groups/<device_group>/events', methods=["GET"])
+@multi_auth.login_required
+@check_authorization_wrapper(permission_needed="ro", permission_object_type="device_groups")
+def stream_device_group_events(device_group):
+    if get_device_group_version(device_group) is None:
+        return jsonify({"device_group_exists": False}), 403
+    since = request.headers.get("Last-Event-ID", request.args.get("since"))
+    if since is not None:
+        since = get_etag_config_version(since)
+    full_config = request.args.get("full", "false").lower() == "true"
+    device_group_events = generate_device_group_events(device_group, since, full_config, request.args.get('device'))
+    return Response(stream_with_context(device_group_events), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 # create device_group
@@ -460,22 +1223,22 @@ def create_device_group(device_group):
             apps = return_sane_default_if_not_declared("apps", app_json, [])
         except:
             return json.dumps({"missing_parameters": True}), 400
-        # check edge case where cron_jobs is not a list
-        if type(cron_jobs) is not list:
-            return jsonify({"cron_jobs_is_list": False}), 400
-        # check edge case where adding an cron_jobs that does not exist
-        for device_cron_job in cron_jobs:
-            cron_job_exists, cron_job_json = mongo_connection.mongo_get_cron_job(device_cron_job)
-            if cron_job_exists is False:
-                return jsonify({"cron_job_exists": False}), 403
-        # check edge case where apps is not a list
-        if type(apps) is not list:
-            return jsonify({"apps_is_list": False}), 400
-        # check edge case where adding an app that does not exist
-        for device_app in apps:
-            app_exists, app_json = mongo_connection.mongo_get_app(device_app)
-            if app_exists is False:
-                return jsonify({"app_exists": False}), 403
+        # check edge case where cron_jobs is not a list of names
+        names_check_return_message, names_check_return_code = check_names_list(cron_jobs, "cron_jobs")
+        if names_check_return_code >= 300:
+            return names_check_return_message, names_check_return_code
+        # check edge case where adding cron_jobs that do not exist, all the missing ones are returned
+        missing_cron_jobs = mongo_connection.mongo_list_missing_cron_jobs(cron_jobs)
+        if len(missing_cron_jobs) > 0:
+            return jsonify({"cron_job_exists": False, "missing_cron_jobs": missing_cron_jobs}), 403
+        # check edge case where apps is not a list of names
+        names_check_return_message, names_check_return_code = check_names_list(apps, "apps")
+        if names_check_return_code >= 300:
+            return names_check_return_message, names_check_return_code
+        # check edge case where adding apps that do not exist, all the missing ones are returned
+        missing_apps = mongo_connection.mongo_list_missing_apps(apps)
+        if len(missing_apps) > 0:
+            return jsonify({"app_exists": False, "missing_apps": missing_apps}), 403
         # update the db
         app_json = mongo_connection.mongo_add_device_group(device_group, apps, cron_jobs)
         return dumps(app_json), 200
@@ -510,22 +1273,22 @@ def update_device_group(device_group):
         apps = return_sane_default_if_not_declared("apps", app_json, [])
     except:
         return json.dumps({"missing_parameters": True}), 400
-    # check edge case where cron_jobs is not a list
-    if type(cron_jobs) is not list:
-        return jsonify({"cron_jobs_is_list": False}), 400
-    # check edge case where adding an cron_jobs that does not exist
-    for device_cron_job in cron_jobs:
-        cron_job_exists, cron_job_json = mongo_connection.mongo_get_cron_job(device_cron_job)
-        if cron_job_exists is False:
-            return jsonify({"cron_job_exists": False}), 403
-    # check edge case where apps is not a list
-    if type(apps) is not list:
-        return jsonify({"apps_is_list": False}), 400
-    # check edge case where adding an app that does not exist
-    for device_app in apps:
-        app_exists, app_json = mongo_connection.mongo_get_app(device_app)
-        if app_exists is False:
-            return jsonify({"app_exists": False}), 403
+    # check edge case where cron_jobs is not a list of names
+    names_check_return_message, names_check_return_code = check_names_list(cron_jobs, "cron_jobs")
+    if names_check_return_code >= 300:
+        return names_check_return_message, names_check_return_code
+    # check edge case where adding cron_jobs that do not exist, all the missing ones are returned
+    missing_cron_jobs = mongo_connection.mongo_list_missing_cron_jobs(cron_jobs)
+    if len(missing_cron_jobs) > 0:
+        return jsonify({"cron_job_exists": False, "missing_cron_jobs": missing_cron_jobs}), 403
+    # check edge case where apps is not a list of names
+    names_check_return_message, names_check_return_code = check_names_list(apps, "apps")
+    if names_check_return_code >= 300:
+        return names_check_return_message, names_check_return_code
+    # check edge case where adding apps that do not exist, all the missing ones are returned
+    missing_apps = mongo_connection.mongo_list_missing_apps(apps)
+    if len(missing_apps) > 0:
+        return jsonify({"app_exists": False, "missing_apps": missing_apps}), 403
     # update db
     update_fields_dict = {"apps": apps, "cron_jobs": cron_jobs}
     app_json = mongo_connection.mongo_update_device_group(device_group, update_fields_dict)
@@ -544,34 +1307,34 @@ def update_device_group_some_params(device_group):
     # check device_group_ got update parameters
     try:
         device_group_json = request.json
-        if len(device_group_json) == 0:
+        if type(device_group_json) is not dict or len(device_group_json) == 0:
             return jsonify({"missing_parameters": True}), 400
     except:
         return jsonify({"missing_parameters": True}), 400
     # check edge case of port being outside of possible port ranges in case trying to update port listing
     try:
         cron_jobs = request.json["cron_jobs"]
-        # check edge case where cron_jobs is not a list
-        if type(cron_jobs) is not list:
-            return jsonify({"cron_jobs_is_list": False}), 400
-        # check edge case where adding an cron_jobs that does not exist
-        for device_cron_job in cron_jobs:
-            cron_job_exists, cron_job_json = mongo_connection.mongo_get_cron_job(device_cron_job)
-            if cron_job_exists is False:
-                return jsonify({"cron_job_exists": False}), 403
-    except:
+        # check edge case where cron_jobs is not a list of names
+        names_check_return_message, names_check_return_code = check_names_list(cron_jobs, "cron_jobs")
+        if names_check_return_code >= 300:
+            return names_check_return_message, names_check_return_code
+        # check edge case where adding cron_jobs that do not exist, all the missing ones are returned
+        missing_cron_jobs = mongo_connection.mongo_list_missing_cron_jobs(cron_jobs)
+        if len(missing_cron_jobs) > 0:
+            return jsonify({"cron_job_exists": False, "missing_cron_jobs": missing_cron_jobs}), 403
+    except KeyError:
         pass
     try:
         apps = request.json["apps"]
-        # check edge case where apps is not a list
-        if type(apps) is not list:
-            return jsonify({"apps_is_list": False}), 400
-        # check edge case where adding an app that does not exist
-        for device_app in apps:
-            app_exists, app_json = mongo_connection.mongo_get_app(device_app)
-            if app_exists is False:
-                return jsonify({"app_exists": False}), 403
-    except:
+        # check edge case where apps is not a list of names
+        names_check_return_message, names_check_return_code = check_names_list(apps, "apps")
+        if names_check_return_code >= 300:
+            return names_check_return_message, names_check_return_code
+        # check edge case where adding apps that do not exist, all the missing ones are returned
+        missing_apps = mongo_connection.mongo_list_missing_apps(apps)
+        if len(missing_apps) > 0:
+            return jsonify({"app_exists": False, "missing_apps": missing_apps}), 403
+    except KeyError:
         pass
     # update db
     device_group_json = mongo_connection.mongo_update_device_group(device_group, request.json)
@@ -598,8 +1361,8 @@ def delete_device_group(device_group):
 @retry(stop_max_attempt_number=3, wait_exponential_multiplier=200, wait_exponential_max=500)
 @multi_auth.login_required
 def list_device_groups():
-    nebula_device_groups_list = mongo_connection.mongo_list_device_groups()
-    return jsonify({"device_groups": nebula_device_groups_list}), 200
+    return list_names_page(mongo_connection.mongo_list_device_groups, "device_groups", collection_name="device_groups",
+                           name_field="device_group", permission_object_type="device_groups")
 
 
 # prune unused images on all devices running said device_group
@@ -616,27 +1379,40 @@ def prune_device_group_images(device_group):
     return dumps(app_json), 202
 
 
-# prune unused images on all devices
+# prune unused images on all devices, the request body can optionally limit the prune to the device groups listed in
+# device_groups and/or matching the device_group_pattern regex & can pass a stagger_window (in seconds) to have the
+# prunes spread over that window instead of all done at once
 @app.route('/api/' + API_VERSION + '/prune', methods=["POST"])
 @multi_auth.login_required
 @check_authorization_wrapper(permission_needed="rw", permission_object_type="pruning")
 def prune_images_on_all_device_groups():
-    # get a list of all device_groups
-    device_groups = mongo_connection.mongo_list_device_groups()
-    all_device_groups_prune_id = {"prune_ids": {}}
-    # loop over all device groups
-    for device_group in device_groups:
-        # check device_group exists first
-        device_group_exists = mongo_connection.mongo_check_device_group_exists(device_group)
-        if device_group_exists is False:
-            return jsonify({"app_exists": False}), 403
-        # update db
-        app_json = mongo_connection.mongo_increase_prune_id(device_group)
-        all_device_groups_prune_id["prune_ids"][device_group] = app_json["prune_id"]
-    return dumps(all_device_groups_prune_id), 202
-
-
-# list reports
+    prune_json = request.get_json(silent=True) or {}
+    if not isinstance(prune_json, dict):
+        return jsonify({"selector_valid": False}), 400
+    device_group_selector = {}
+    if prune_json.get("device_groups") is not None:
+        if not isinstance(prune_json["device_groups"], list) or \
+                not all(isinstance(device_group, str) for device_group in prune_json["device_groups"]):
+            return jsonify({"selector_valid": False}), 400
+        device_group_selector["device_groups"] = prune_json["device_groups"]
+    if prune_json.get("device_group_pattern") is not None:
+        try:
+            re.compile(prune_json["device_group_pattern"])
+        except (re.error, TypeError):
+            return jsonify({"selector_valid": False}), 400
+        device_group_selector["device_group_pattern"] = prune_json["device_group_pattern"]
+    stagger_window = prune_json.get("stagger_window", 0)
+    if not isinstance(stagger_window, (int, float)) or stagger_window < 0:
+        return jsonify({"stagger_window_valid": False}), 400
+    if stagger_window > 0:
+        prune_schedule = mongo_connection.mongo_schedule_device_groups_prune(device_group_selector, stagger_window)
+        return dumps({"prune_scheduled_at": prune_schedule}), 202
+    prune_ids = mongo_connection.mongo_prune_device_groups(device_group_selector)
+    return dumps({"prune_ids": prune_ids}), 202
+
+
+# list reports, each query is hinted to use the index matching its filters & is stopped after reports_max_time_ms,
+# passing explain=true adds a summary of how the query was planned & run to the reply
 @app.route('/api/' + API_VERSION + '/reports', methods=["GET"])
 @retry(stop_max_attempt_number=3, wait_exponential_multiplier=200, wait_exponential_max=500)
 @multi_auth.login_required
@@ -646,30 +1422,59 @@ def get_report():
     # format MongoDB uses to filtering
     last_id = request.args.get('last_id')
     page_size = request.args.get('page_size', 10, int)
-    hostname = get_param_filter("hostname", request)
-    device_group = get_param_filter("device_group", request)
-    report_creation_time_filter = request.args.get('report_creation_time_filter', "eq", str)
-    report_creation_time = get_param_filter("report_creation_time", request, filter_param=report_creation_time_filter,
-                                            request_type=int)
-    updated = get_param_filter("updated", request, filter_param="eq", request_type=str)
-
-    # Now we combine all the filters
-    filters = {}
-    for filter_option in [hostname, device_group, report_creation_time, updated]:
-        if filter_option is not None:
-            filters = {**filters, **filter_option}
+    filters = get_reports_filters(request)
 
     # lastly we return the requests reports to the user
-    data, last_id = mongo_connection.mango_list_paginated_filtered_reports(page_size=page_size, last_id=last_id,
-                                                                           filters=filters)
+    query_plan = None
+    try:
+        if request.args.get('explain', 'false').lower() == 'true':
+            query_plan = mongo_connection.mongo_explain_filtered_reports(page_size=page_size, last_id=last_id,
+                                                                         filters=filters,
+                                                                         max_time_ms=reports_max_time_ms)
+        data, last_id = mongo_connection.mango_list_paginated_filtered_reports(page_size=page_size, last_id=last_id,
+                                                                               filters=filters,
+                                                                               max_time_ms=reports_max_time_ms)
+    except ExecutionTimeout:
+        return jsonify({"reports_query_timeout": True}), 504
     reply = {"data": data, "last_id": last_id}
+    if query_plan is not None:
+        reply["query_plan"] = query_plan
     return dumps(reply), 200
 
 
-# set json header - the API is JSON only so the header is set on all requests
+# list the latest report of each hostname, optionally only of the hostnames whose latest report is from device_group
+@app.route('/api/' + API_VERSION + '/reports/latest', methods=["GET"])
+@retry(stop_max_attempt_number=3, wait_exponential_multiplier=200, wait_exponential_max=500)
+@multi_auth.login_required
+def get_latest_reports():
+    latest_reports = mongo_connection.mongo_list_latest_reports(request.args.get('device_group'))
+    return dumps({"data": latest_reports}), 200
+
+
+# export all the reports matching the filters (starting after last_id if given) as a stream of newline delimited JSON,
+# the cursor is iterated reports_export_batch_size reports at a time so memory use is flat no matter how many reports
+# match, the stream is gzip compressed if the client Accept-Encoding allows it
+@app.route('/api/' + API_VERSION + '/reports/export', methods=["GET"])
+@multi_auth.login_required
+def export_reports():
+    filters = get_reports_filters(request)
+    reports = mongo_connection.mongo_find_filtered_reports(filters, request.args.get('last_id'),
+                                                           batch_size=reports_export_batch_size)
+    content_encoding = request.accept_encodings.best_match(["gzip", "identity"], default="identity")
+    reports_export = generate_reports_export(reports, content_encoding, reports_export_batch_size)
+    response = Response(reports_export, mimetype="application/x-ndjson", headers={"X-Accel-Buffering": "no"})
+    response.vary.add("Accept-Encoding")
+    if content_encoding != "identity":
+        response.content_encoding = content_encoding
+    return response
+
+
+# set json header - the API is JSON only so the header is set on all requests that didn't explicitly set another type
+# (like the device group events stream)
 @app.after_request
 def apply_caching(response):
-    response.headers["Content-Type"] = "application/json"
+    if response.mimetype == app.response_class.default_mimetype:
+        response.headers["Content-Type"] = "application/json"
     return response
 
 
@@ -678,8 +1483,7 @@ def apply_caching(response):
 @retry(stop_max_attempt_number=3, wait_exponential_multiplier=200, wait_exponential_max=500)
 @multi_auth.login_required
 def list_users():
-    nebula_users_list = mongo_connection.mongo_list_users()
-    return jsonify({"users": nebula_users_list}), 200
+    return list_names_page(mongo_connection.mongo_list_users, "users")
 
 
 # get user info
@@ -706,6 +1510,7 @@ def delete_user(user_name):
         return jsonify({"user_exists": False}), 403
     # remove from db
     mongo_connection.mongo_delete_user(user_name)
+    verified_secrets_cache.invalidate_user(user_name)
     return "{}", 200
 
 
@@ -725,18 +1530,31 @@ def update_user(user_name):
             return jsonify({"missing_parameters": True}), 400
     except:
         return jsonify({"missing_parameters": True}), 400
-    # if part of the update includes a token hash it
+    # if part of the update includes a token hash it & update the token_id to match it, a token whose token_id is
+    # already used by another user is refused
     try:
-        request.json["token"] = hash_secret(request.json["token"])
+        request.json["token_id"] = get_token_id(request.json["token"])
+        if request.json["token_id"] is not None and \
+                mongo_connection.mongo_check_token_id_taken(request.json["token_id"], user_name) is True:
+            return jsonify({"token_id_exists": True}), 409
+        request.json["token"] = hashing_pool.hash_secret(request.json["token"])
+    except HashingQueueFull:
+        raise
     except:
         pass
     # if part of the update includes a password hash it
     try:
-        request.json["password"] = hash_secret(request.json["password"])
+        request.json["password"] = hashing_pool.hash_secret(request.json["password"])
+    except HashingQueueFull:
+        raise
     except:
         pass
     # update db
-    user_json = mongo_connection.mongo_update_user(user_name, request.json)
+    try:
+        user_json = mongo_connection.mongo_update_user(user_name, request.json)
+    except DuplicateKeyError:
+        return jsonify({"token_id_exists": True}), 409
+    verified_secrets_cache.invalidate_user(user_name)
     return dumps(user_json), 200
 
 
@@ -751,13 +1569,17 @@ def refresh_user_token(user_name):
         return jsonify({"user_name": False}), 403
     # get current user data and update the token for him
     try:
-        new_token = secrets.token_urlsafe()
+        new_token = generate_token()
         app_exists, user_json = mongo_connection.mongo_get_user(user_name)
-        user_json["token"] = hash_secret(new_token)
+        user_json["token"] = hashing_pool.hash_secret(new_token)
+        user_json["token_id"] = get_token_id(new_token)
+    except HashingQueueFull:
+        raise
     except:
         return jsonify({"token_refreshed": False}), 403
     # update db
     user_json = mongo_connection.mongo_update_user(user_name, user_json)
+    verified_secrets_cache.invalidate_user(user_name)
     return jsonify({"token": new_token}), 200
 
 
@@ -778,12 +1600,22 @@ def create_user(user_name):
             return jsonify({"missing_parameters": True}), 400
         try:
             # hash the password & token, if not declared generates them randomly
-            password = hash_secret(return_sane_default_if_not_declared("password", user_json, secrets.token_urlsafe()))
-            token = hash_secret(return_sane_default_if_not_declared("token", user_json, secrets.token_urlsafe()))
+            password = hashing_pool.hash_secret(return_sane_default_if_not_declared("password", user_json,
+                                                                                    secrets.token_urlsafe()))
+            token = return_sane_default_if_not_declared("token", user_json, generate_token())
+            token_id = get_token_id(token)
+            if token_id is not None and mongo_connection.mongo_check_token_id_taken(token_id) is True:
+                return jsonify({"token_id_exists": True}), 409
+            token = hashing_pool.hash_secret(token)
+        except HashingQueueFull:
+            raise
         except:
             return jsonify({"missing_parameters": True}), 400
-        # update the db
-        user_json = mongo_connection.mongo_add_user(user_name, password, token)
+        # update the db, a token_id taken by another user in the meantime is refused by its unique index
+        try:
+            user_json = mongo_connection.mongo_add_user(user_name, password, token, token_id)
+        except DuplicateKeyError:
+            return jsonify({"token_id_exists": True}), 409
         return dumps(user_json), 200
 
 
@@ -858,8 +1690,8 @@ def delete_user_group(user_group):
 @retry(stop_max_attempt_number=3, wait_exponential_multiplier=200, wait_exponential_max=500)
 @multi_auth.login_required
 def list_user_groups():
-    nebula_user_groups_list = mongo_connection.mongo_list_user_groups()
-    return jsonify({"user_groups": nebula_user_groups_list}), 200
+    return list_names_page(mongo_connection.mongo_list_user_groups, "user_groups", collection_name="user_groups",
+                           name_field="user_group", permission_object_type="admin")
 
 
 # get user_group info
@@ -912,8 +1744,8 @@ def create_cron_job(cron_job):
 @retry(stop_max_attempt_number=3, wait_exponential_multiplier=200, wait_exponential_max=500)
 @multi_auth.login_required
 def list_cron_jobs():
-    nebula_cron_jobs_list = mongo_connection.mongo_list_cron_jobs()
-    return jsonify({"cron_jobs": nebula_cron_jobs_list}), 200
+    return list_names_page(mongo_connection.mongo_list_cron_jobs, "cron_jobs", collection_name="cron_jobs",
+                           name_field="cron_job_name", permission_object_type="cron_jobs")
 
 
 # list cron_job
@@ -929,6 +1761,16 @@ def get_cron_job(cron_job):
         return jsonify({"cron_job_exists": False}), 403
 
 
+# list the device groups that use a cron job
+@app.route('/api/' + API_VERSION + '/cron_jobs/<cron_job>/device_groups', methods=["GET"])
+@retry(stop_max_attempt_number=3, wait_exponential_multiplier=200, wait_exponential_max=500)
+@multi_auth.login_required
+@check_authorization_wrapper(permission_needed="ro", permission_object_type="cron_jobs")
+def list_cron_job_device_groups(cron_job):
+    device_groups = mongo_connection.mongo_list_cached_device_group_references("cron_jobs", cron_job)
+    return jsonify({"device_groups": device_groups}), 200
+
+
 # PUT update some fields of an cron job - params not given will be unchanged from their current value
 @app.route('/api/' + API_VERSION + '/cron_jobs/<cron_job>/update', methods=["PUT", "PATCH"])
 @multi_auth.login_required
@@ -1,3 +1,4 @@
+import gzip
 from unittest import TestCase
 from manager import *
 
@@ -23,3 +24,56 @@ class BaseTests(TestCase):
     def test_check_ports_valid_range_port_not_in_range(self):
         test_reply, text_reply_code = check_ports_valid_range([80, 643681, 81])
         self.assertEqual(text_reply_code, 400)
+
+    def test_check_names_list_only_names(self):
+        test_reply, test_reply_code = check_names_list(["test_app", "other_test_app"], "apps")
+        self.assertEqual(test_reply_code, 200)
+
+    def test_check_names_list_not_names(self):
+        test_reply, test_reply_code = check_names_list([["test_app"], "other_test_app"], "apps")
+        self.assertEqual(test_reply_code, 400)
+        self.assertEqual(json.loads(test_reply), {"apps_are_names": False})
+        test_reply, test_reply_code = check_names_list([{"x": 1}], "cron_jobs")
+        self.assertEqual(test_reply_code, 400)
+        test_reply, test_reply_code = check_names_list("test_app", "apps")
+        self.assertEqual(json.loads(test_reply), {"apps_is_list": False})
+
+    def test_get_config_version_matches_config_versions(self):
+        test_config = {"apps": [{"app_name": "test_app", "app_id": 2}], "apps_list": ["test_app"], "prune_id": 1,
+                       "cron_jobs": [], "cron_jobs_list": [], "device_group_id": 3}
+        test_versions = {"device_group_id": 3, "prune_id": 1, "apps": {"test_app": 2}, "cron_jobs": {}}
+        self.assertEqual(get_device_group_config_versions(test_config), test_versions)
+        self.assertEqual(get_config_version(get_device_group_config_versions(test_config)),
+                         get_config_version(test_versions))
+
+    def test_get_config_version_changes_with_counters(self):
+        test_versions = {"device_group_id": 3, "prune_id": 1, "apps": {"test_app": 2}, "cron_jobs": {}}
+        test_changed_versions = {"device_group_id": 3, "prune_id": 1, "apps": {"test_app": 3}, "cron_jobs": {}}
+        self.assertNotEqual(get_config_version(test_versions), get_config_version(test_changed_versions))
+
+    def test_get_config_version_changes_with_config_digest(self):
+        test_versions = {"device_group_id": 1, "prune_id": 1, "apps": {"test_app": 1}, "cron_jobs": {},
+                         "config_digest": get_config_digest('{"apps": [{"docker_image": "wrong:1"}]}')}
+        test_changed_versions = {"device_group_id": 1, "prune_id": 1, "apps": {"test_app": 1}, "cron_jobs": {},
+                                 "config_digest": get_config_digest('{"apps": [{"docker_image": "right:1"}]}')}
+        self.assertNotEqual(get_config_version(test_versions), get_config_version(test_changed_versions))
+
+    def test_generate_reports_export_is_chunked_ndjson(self):
+        test_reports = [{"hostname": "test_host_" + str(report_number)} for report_number in range(5)]
+        test_chunks = list(generate_reports_export(test_reports, chunk_size=2))
+        self.assertEqual(len(test_chunks), 3)
+        test_lines = b"".join(test_chunks).decode('utf-8').splitlines()
+        self.assertEqual([json.loads(test_line) for test_line in test_lines], test_reports)
+
+    def test_generate_reports_export_gzip_matches_identity(self):
+        test_reports = [{"hostname": "test_host_" + str(report_number)} for report_number in range(5)]
+        test_gzip_export = b"".join(generate_reports_export(test_reports, "gzip", chunk_size=2))
+        test_identity_export = b"".join(generate_reports_export(test_reports, chunk_size=2))
+        self.assertEqual(gzip.decompress(test_gzip_export), test_identity_export)
+
+    def test_get_config_etag_is_per_content_encoding(self):
+        test_version = get_config_version({"device_group_id": 1, "prune_id": 1, "apps": {}, "cron_jobs": {}})
+        self.assertEqual(get_config_etag(test_version, "identity"), test_version)
+        self.assertNotEqual(get_config_etag(test_version, "gzip"), test_version)
+        self.assertEqual(get_etag_config_version(get_config_etag(test_version, "gzip")), test_version)
+        self.assertEqual(get_etag_config_version('"' + test_version + '"'), test_version)
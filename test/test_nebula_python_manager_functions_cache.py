@@ -0,0 +1,91 @@
+from unittest import TestCase
+from functions.cache.cache import *
+import tempfile
+
+
+class CacheTests(TestCase):
+
+    def test_memory_cache_flow(self):
+        test_cache = MemoryCache(max_size=2)
+
+        # check values are cached until they expire or are deleted
+        test_cache.set("test_key", b"test_value")
+        test_cache.set("test_expired_key", b"test_value", ttl=-1)
+        self.assertEqual(test_cache.get("test_key"), b"test_value")
+        self.assertIsNone(test_cache.get("test_expired_key"))
+        test_cache.delete("test_key")
+        self.assertIsNone(test_cache.get("test_key"))
+
+        # check the least recently used value is evicted once the cache is full
+        test_cache.set("test_key_1", b"test_value_1")
+        test_cache.set("test_key_2", b"test_value_2")
+        test_cache.set("test_key_3", b"test_value_3")
+        self.assertIsNone(test_cache.get("test_key_1"))
+        test_cache.clear()
+        self.assertIsNone(test_cache.get("test_key_3"))
+
+    def test_shared_memory_cache_flow(self):
+        with tempfile.TemporaryDirectory() as test_dir:
+            test_cache_path = os.path.join(test_dir, "test_cache")
+            test_cache = SharedMemoryCache(test_cache_path, 4096, slot_size=256)
+            test_other_cache = SharedMemoryCache(test_cache_path, 4096, slot_size=256)
+
+            # check values set by one opener are seen by others of the same file until they expire or are deleted
+            self.assertTrue(test_cache.set("test_key", b"test_value"))
+            self.assertTrue(test_cache.set("test_expired_key", b"test_value", ttl=-1))
+            self.assertEqual(test_other_cache.get("test_key"), b"test_value")
+            self.assertIsNone(test_other_cache.get("test_expired_key"))
+            self.assertTrue(test_other_cache.set("test_key", b"test_new_value"))
+            self.assertEqual(test_cache.get("test_key"), b"test_new_value")
+            test_other_cache.delete("test_key")
+            self.assertIsNone(test_cache.get("test_key"))
+
+            # check values too large for a slot are not cached
+            self.assertFalse(test_cache.set("test_large_key", b"x" * 256))
+            self.assertIsNone(test_cache.get("test_large_key"))
+            self.assertEqual(test_cache.get_stats()["oversized_values"], 1)
+
+            # check opening the file with a different layout resets it
+            test_cache.set("test_key", b"test_value")
+            test_resized_cache = SharedMemoryCache(test_cache_path, 8192, slot_size=512)
+            self.assertIsNone(test_resized_cache.get("test_key"))
+
+    def test_shared_memory_cache_overflow(self):
+        with tempfile.TemporaryDirectory() as test_dir:
+            test_cache = SharedMemoryCache(os.path.join(test_dir, "test_cache"), 4096, slot_size=256,
+                                           overflow_max_size=2)
+
+            # check values larger then a slot are counted & kept in the overflow cache until deleted or cleared
+            self.assertTrue(test_cache.set("test_large_key", b"x" * 1024))
+            self.assertEqual(test_cache.get("test_large_key"), b"x" * 1024)
+            self.assertEqual(test_cache.get_stats()["oversized_values"], 1)
+            self.assertEqual(test_cache.get_stats()["overflow"]["size"], 1)
+            test_cache.delete("test_large_key")
+            self.assertIsNone(test_cache.get("test_large_key"))
+            self.assertTrue(test_cache.set("test_large_key", b"x" * 1024))
+            test_cache.clear()
+            self.assertIsNone(test_cache.get("test_large_key"))
+
+    def test_shared_memory_cache_clear(self):
+        with tempfile.TemporaryDirectory() as test_dir:
+            test_cache = SharedMemoryCache(os.path.join(test_dir, "test_cache"), 4096, slot_size=256)
+
+            # check many keys fit in the cache & clearing it removes them all
+            for test_key_number in range(8):
+                test_cache.set("test_key_" + str(test_key_number), str(test_key_number).encode('utf-8'))
+            self.assertEqual(test_cache.get("test_key_7"), b"7")
+            test_cache.clear()
+            for test_key_number in range(8):
+                self.assertIsNone(test_cache.get("test_key_" + str(test_key_number)))
+
+    def test_encode_content(self):
+        test_body = b'{"test_key": "test_value"}' * 100
+
+        # check the body is encoded in all the content encodings & each decodes back to it
+        test_encoded_bodies = encode_content(test_body)
+        self.assertEqual(sorted(test_encoded_bodies.keys()), sorted(CONTENT_ENCODINGS))
+        self.assertEqual(test_encoded_bodies["identity"], test_body)
+        self.assertEqual(gzip.decompress(test_encoded_bodies["gzip"]), test_body)
+        self.assertLess(len(test_encoded_bodies["gzip"]), len(test_body))
+        if brotli is not None:
+            self.assertEqual(brotli.decompress(test_encoded_bodies["br"]), test_body)
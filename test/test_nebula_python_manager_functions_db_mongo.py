@@ -1,6 +1,7 @@
 from unittest import TestCase
 from functions.db.mongo import *
 from functions.hashing.hashing import *
+from pymongo.errors import DuplicateKeyError
 
 
 def mongo_connection():
@@ -41,6 +42,23 @@ def create_temp_cron_job(mongo_connection_object, cron_job):
 
 class MongoTests(TestCase):
 
+    # create the indexes the flows rely on (like the unique app_name index duplicate creates are refused by) the same
+    # way the manager does at startup so the tests don't depend on the manager being imported before them
+    @classmethod
+    def setUpClass(cls):
+        mongo_connection_object = mongo_connection()
+        mongo_connection_object.mongo_create_index("apps", "app_name")
+        mongo_connection_object.mongo_create_index("device_groups", "device_group")
+        mongo_connection_object.mongo_create_index("users", "user_name")
+        mongo_connection_object.mongo_create_index("user_groups", "user_group")
+        mongo_connection_object.mongo_create_index("cron_jobs", "cron_job_name")
+        mongo_connection_object.mongo_create_token_id_index()
+        mongo_connection_object.mongo_create_index("device_groups", "apps", unique=False)
+        mongo_connection_object.mongo_create_index("device_groups", "cron_jobs", unique=False)
+        mongo_connection_object.mongo_create_index("apps", "docker_image", unique=False)
+        mongo_connection_object.mongo_create_index("device_groups", "prune_scheduled_at", unique=False)
+        mongo_connection_object.mongo_create_reports_indexes()
+
     def test_mongo_cron_job_flow(self):
         mongo_connection_object = mongo_connection()
 
@@ -217,6 +235,22 @@ class MongoTests(TestCase):
         test_reply = mongo_connection_object.mongo_list_apps()
         self.assertEqual(test_reply, ["unit_test_app"])
 
+        # check listing apps in pages works
+        create_temp_app(mongo_connection_object, "unit_test_app_2")
+        test_reply = mongo_connection_object.mongo_list_apps(limit=1)
+        self.assertEqual(test_reply, ["unit_test_app"])
+        test_reply = mongo_connection_object.mongo_list_apps(limit=1, after="unit_test_app")
+        self.assertEqual(test_reply, ["unit_test_app_2"])
+        test_reply = mongo_connection_object.mongo_list_apps(after="unit_test_app_2")
+        self.assertEqual(test_reply, [])
+
+        # check listing the full apps of a page limited to some names & fields works
+        test_reply = list(mongo_connection_object.mongo_iterate_documents("apps", "app_name",
+                                                                          names=["unit_test_app_2"],
+                                                                          fields=["docker_image"]))
+        self.assertEqual(test_reply, [{"app_name": "unit_test_app_2", "docker_image": "nginx"}])
+        mongo_connection_object.mongo_remove_app("unit_test_app_2")
+
         # check update test app works
         test_reply = mongo_connection_object.mongo_increase_app_id("unit_test_app")
         test_app_id = test_reply["app_id"]
@@ -295,12 +329,164 @@ class MongoTests(TestCase):
         test_reply = mongo_connection_object.mongo_check_device_group_exists("unit_test_device_group")
         self.assertTrue(test_reply)
 
+        # check getting the device group config with all of its apps & cron jobs works
+        mongo_connection_object.mongo_remove_app("unit_test_device_group_app")
+        mongo_connection_object.mongo_delete_cron_job("unit_test_device_group_cron_job")
+        create_temp_app(mongo_connection_object, "unit_test_device_group_app")
+        create_temp_cron_job(mongo_connection_object, "unit_test_device_group_cron_job")
+        mongo_connection_object.mongo_update_device_group("unit_test_device_group", {
+            "apps": ["unit_test_device_group_app", "unit_test_app_that_doesnt_exist"],
+            "cron_jobs": ["unit_test_device_group_cron_job"]
+        })
+        device_group_exists, test_reply = mongo_connection_object.mongo_get_device_group_config(
+            "unit_test_device_group")
+        self.assertTrue(device_group_exists)
+        self.assertEqual(test_reply["apps_list"], ["unit_test_device_group_app"])
+        self.assertEqual(test_reply["apps"][0]["docker_image"], "nginx")
+        self.assertEqual(test_reply["cron_jobs_list"], ["unit_test_device_group_cron_job"])
+        self.assertEqual(test_reply["device_group_id"], 3)
+        self.assertEqual(test_reply["prune_id"], 1)
+        device_group_exists, test_reply = mongo_connection_object.mongo_get_device_group_config(
+            "unit_test_device_group_that_doesnt_exist")
+        self.assertFalse(device_group_exists)
+
+        # check reading the versions of a device group that doesn't exist writes no materialized config for it
+        device_group_exists, test_reply = mongo_connection_object.mongo_get_device_group_versions(
+            "unit_test_device_group_that_doesnt_exist")
+        self.assertFalse(device_group_exists)
+        self.assertIsNone(mongo_connection_object.collection["device_group_configs"].find_one(
+            {"_id": "unit_test_device_group_that_doesnt_exist"}))
+
+        # check all the apps & cron jobs that don't exist are listed as missing
+        test_reply = mongo_connection_object.mongo_list_missing_apps(["unit_test_device_group_app",
+                                                                      "unit_test_app_that_doesnt_exist"])
+        self.assertEqual(test_reply, ["unit_test_app_that_doesnt_exist"])
+        test_reply = mongo_connection_object.mongo_list_missing_cron_jobs(["unit_test_device_group_cron_job"])
+        self.assertEqual(test_reply, [])
+        test_reply = mongo_connection_object.mongo_list_missing_apps(["unit_test_app_that_doesnt_exist",
+                                                                      "unit_test_device_group_app",
+                                                                      "unit_test_other_app_that_doesnt_exist"])
+        self.assertEqual(test_reply, ["unit_test_app_that_doesnt_exist", "unit_test_other_app_that_doesnt_exist"])
+        test_reply = mongo_connection_object.mongo_list_missing_cron_jobs(
+            ["unit_test_cron_job_that_doesnt_exist", "unit_test_other_cron_job_that_doesnt_exist"])
+        self.assertEqual(test_reply, ["unit_test_cron_job_that_doesnt_exist",
+                                      "unit_test_other_cron_job_that_doesnt_exist"])
+
+        # check anything given that isn't a name is listed as missing instead of failing the check
+        test_reply = mongo_connection_object.mongo_list_missing_apps([["unit_test_device_group_app"],
+                                                                      "unit_test_device_group_app", {"x": 1}])
+        self.assertEqual(test_reply, [["unit_test_device_group_app"], {"x": 1}])
+
+        # check listing the device groups that use an app or a cron job works
+        test_reply = mongo_connection_object.mongo_list_cached_device_group_references("apps",
+                                                                                      "unit_test_device_group_app")
+        self.assertEqual(test_reply, ["unit_test_device_group"])
+        test_reply = mongo_connection_object.mongo_list_cron_job_device_groups("unit_test_device_group_cron_job")
+        self.assertEqual(test_reply, ["unit_test_device_group"])
+        test_reply = mongo_connection_object.mongo_list_app_device_groups("unit_test_app_that_no_group_uses")
+        self.assertEqual(test_reply, [])
+
+        # check getting the device group version counters works
+        device_group_exists, test_reply = mongo_connection_object.mongo_get_device_group_versions(
+            "unit_test_device_group")
+        self.assertTrue(device_group_exists)
+        self.assertEqual(len(test_reply.pop("config_digest")), 16)
+        self.assertEqual(test_reply, {"device_group_id": 3, "prune_id": 1, "apps": {"unit_test_device_group_app": 1},
+                                      "cron_jobs": {"unit_test_device_group_cron_job": 1}})
+
+        # check the materialized device group config is marked stale when one of its apps changes & rebuilt on read
+        mongo_connection_object.mongo_increase_app_id("unit_test_device_group_app")
+        test_result = mongo_connection_object.collection["device_group_configs"].find_one(
+            {"_id": "unit_test_device_group"})
+        self.assertFalse(is_device_group_config_fresh(test_result, "config_json"))
+        device_group_exists, test_versions, test_reply = mongo_connection_object.mongo_get_device_group_config_json(
+            "unit_test_device_group")
+        self.assertTrue(device_group_exists)
+        self.assertEqual(mongo_connection_object.device_group_config_rebuilds, {})
+        self.assertEqual(test_versions["apps"], {"unit_test_device_group_app": 2})
+        self.assertIn('"app_id": 2', test_reply)
+        self.assertEqual(test_versions["config_digest"], get_config_digest(test_reply))
+
+        # check bulk app operations are applied & mark the configs of the device groups using the apps stale
+        test_reply = mongo_connection_object.mongo_bulk_update_apps([
+            ("patch", "unit_test_device_group_app", {"env_vars": {"TEST": "test456"}}),
+            ("create", "unit_test_device_group_app", {"starting_ports": [], "containers_per": {"server": 1},
+                                                      "env_vars": {}, "docker_image": "nginx"})
+        ])
+        self.assertEqual(list(test_reply.keys()), [1])
+        device_group_exists, test_versions = mongo_connection_object.mongo_get_device_group_versions(
+            "unit_test_device_group")
+        self.assertEqual(test_versions["apps"], {"unit_test_device_group_app": 3})
+        mongo_connection_object.mongo_bulk_update_apps([("restart", "unit_test_device_group_app", None)])
+        device_group_exists, test_versions, test_reply = mongo_connection_object.mongo_get_device_group_config_json(
+            "unit_test_device_group")
+        self.assertEqual(test_versions["apps"], {"unit_test_device_group_app": 4})
+
+        # check updating all the apps a selector matches works
+        test_reply = mongo_connection_object.mongo_update_selected_apps({"docker_image_prefix": "ngin",
+                                                                         "device_groups": ["unit_test_device_group"]},
+                                                                        {"docker_image": "nginx:stable"})
+        self.assertEqual(test_reply, {"unit_test_device_group_app": 5})
+        test_reply = mongo_connection_object.mongo_update_selected_apps({"app_name_pattern": "^unit_test_"},
+                                                                        allowed_app_names=[])
+        self.assertEqual(test_reply, {})
+
+        # check the config delta only has the apps changed since the given version counters & the removed ones
+        device_group_exists, test_reply = mongo_connection_object.mongo_get_device_group_config_delta(
+            "unit_test_device_group", {"device_group_id": 3, "prune_id": 1,
+                                       "apps": {"unit_test_device_group_app": 1, "unit_test_removed_app": 1},
+                                       "cron_jobs": {"unit_test_device_group_cron_job": 1}})
+        self.assertTrue(device_group_exists)
+        self.assertEqual([app["app_id"] for app in test_reply["apps"]], [5])
+        self.assertEqual(test_reply["removed_apps"], ["unit_test_removed_app"])
+        self.assertEqual(test_reply["cron_jobs"], [])
+        self.assertEqual(test_reply["removed_cron_jobs"], [])
+        self.assertEqual(test_reply["version_vector"]["apps"], {"unit_test_device_group_app": 5})
+
+        # check apps held back from a device are compared & returned at their previous version
+        device_group_exists, test_reply = mongo_connection_object.mongo_get_device_group_config_delta(
+            "unit_test_device_group", {"device_group_id": 3, "prune_id": 1,
+                                       "apps": {"unit_test_device_group_app": 1},
+                                       "cron_jobs": {"unit_test_device_group_cron_job": 1}},
+            {"unit_test_device_group_app": {"app_name": "unit_test_device_group_app", "app_id": 4}})
+        self.assertEqual(test_reply["apps"], [{"app_name": "unit_test_device_group_app", "app_id": 4}])
+        self.assertEqual(test_reply["version_vector"]["apps"], {"unit_test_device_group_app": 4})
+
+        # check changing an app with a rollout policy & rolling_restart set starts a rollout from its previous version
+        app_exists, test_reply = mongo_connection_object.mongo_set_app_rollout_policy("unit_test_device_group_app",
+                                                                                      50, 60)
+        self.assertTrue(app_exists)
+        self.assertEqual(test_reply["current_app"]["app_id"], 5)
+        mongo_connection_object.mongo_update_app_fields("unit_test_device_group_app", {"rolling_restart": True})
+        test_reply = mongo_connection_object.mongo_list_active_app_rollouts()
+        self.assertEqual(test_reply["unit_test_device_group_app"]["previous_app"]["app_id"], 5)
+        self.assertEqual(test_reply["unit_test_device_group_app"]["current_app"]["app_id"], 6)
+        mongo_connection_object.mongo_remove_app("unit_test_device_group_app")
+        app_rollout_exists, test_reply = mongo_connection_object.mongo_get_app_rollout("unit_test_device_group_app")
+        self.assertFalse(app_rollout_exists)
+        mongo_connection_object.mongo_delete_cron_job("unit_test_device_group_cron_job")
+
         # check increase prune id works
         test_reply = mongo_connection_object.mongo_increase_prune_id("unit_test_device_group")
         test_prune_id = test_reply["prune_id"]
         test_reply = mongo_connection_object.mongo_increase_prune_id("unit_test_device_group")
         self.assertEqual(test_reply["prune_id"], test_prune_id + 1)
 
+        # check pruning all the device groups a selector matches works
+        test_reply = mongo_connection_object.mongo_prune_device_groups({"device_groups": ["unit_test_device_group"]})
+        self.assertEqual(test_reply, {"unit_test_device_group": test_prune_id + 2})
+
+        # check staggered prunes are only done once due
+        test_reply = mongo_connection_object.mongo_schedule_device_groups_prune(
+            {"device_group_pattern": "^unit_test_device_group$"}, 3600)
+        self.assertEqual(list(test_reply.keys()), ["unit_test_device_group"])
+        test_reply = mongo_connection_object.mongo_run_scheduled_prunes()
+        self.assertEqual(test_reply, ["unit_test_device_group"])
+        test_reply = mongo_connection_object.mongo_run_scheduled_prunes()
+        self.assertEqual(test_reply, [])
+        device_group_exists, test_reply = mongo_connection_object.mongo_get_device_group("unit_test_device_group")
+        self.assertEqual(test_reply["prune_id"], test_prune_id + 3)
+
         # check delete device group works
         test_reply = mongo_connection_object.mongo_remove_device_group("unit_test_device_group")
         self.assertEqual(test_reply.deleted_count, 1)
@@ -327,14 +513,41 @@ class MongoTests(TestCase):
         test_reply = mongo_connection_object.mongo_list_users()
         self.assertEqual(test_reply, ["unit_test_user"])
 
-        # check update user works
+        # check update user works & increases the permissions version
+        test_permissions_version = mongo_connection_object.mongo_get_permissions_version()
         test_reply = mongo_connection_object.mongo_update_user("unit_test_user", {"token": "new_unit_test_token"})
         self.assertEqual("new_unit_test_token", test_reply["token"])
+        self.assertEqual(mongo_connection_object.mongo_get_permissions_version(), test_permissions_version + 1)
+
+        # check a token_id used by one user is reported as taken for any other user & can't be given to another user
+        mongo_connection_object.mongo_delete_user("unit_test_user_2")
+        mongo_connection_object.mongo_update_user("unit_test_user", {"token_id": "0123456789abcdef"})
+        self.assertFalse(mongo_connection_object.mongo_check_token_id_taken("0123456789abcdef", "unit_test_user"))
+        self.assertTrue(mongo_connection_object.mongo_check_token_id_taken("0123456789abcdef", "unit_test_user_2"))
+        self.assertTrue(mongo_connection_object.mongo_check_token_id_taken("0123456789abcdef"))
+        with self.assertRaises(DuplicateKeyError):
+            mongo_connection_object.mongo_add_user("unit_test_user_2", "unit_test_pass", "unit_test_token",
+                                                   "0123456789abcdef")
+        mongo_connection_object.mongo_update_user("unit_test_user", {"token_id": None})
 
         # check user exists works
         test_reply = mongo_connection_object.mongo_check_user_exists("unit_test_user")
         self.assertTrue(test_reply)
 
+        # check a user with a legacy token is listed as one & can't be found by a token_id
+        test_reply = mongo_connection_object.mongo_list_legacy_token_users()
+        self.assertIn({"user_name": "unit_test_user", "token": "new_unit_test_token"}, test_reply)
+        user_exists, test_reply = mongo_connection_object.mongo_get_user_by_token_id("0123456789abcdef")
+        self.assertFalse(user_exists)
+
+        # check getting a user by his token_id works
+        mongo_connection_object.mongo_update_user("unit_test_user", {"token_id": "0123456789abcdef"})
+        user_exists, test_reply = mongo_connection_object.mongo_get_user_by_token_id("0123456789abcdef")
+        self.assertTrue(user_exists)
+        self.assertEqual(test_reply["user_name"], "unit_test_user")
+        test_reply = mongo_connection_object.mongo_list_legacy_token_users()
+        self.assertNotIn({"user_name": "unit_test_user", "token": "new_unit_test_token"}, test_reply)
+
         # check delete user works
         test_reply = mongo_connection_object.mongo_delete_user("unit_test_user")
         self.assertEqual(test_reply.deleted_count, 1)
@@ -440,6 +653,13 @@ class MongoTests(TestCase):
         self.assertEqual(test_reply["device_groups"], device_groups_results)
         self.assertEqual(test_reply["cron_jobs"], cron_jobs_results)
 
+        # check the compiled user permissions are refreshed when a user_group changes
+        mongo_connection_object.mongo_update_user_group("unit_test_user_group_2", {"apps": {"unit_test_app_3": "ro"}})
+        test_reply = mongo_connection_object.mongo_list_user_permissions("unit_test_member_1")
+        self.assertEqual(test_reply["apps"]["unit_test_app_3"], "ro")
+        self.assertNotIn("unit_test_app_4", test_reply["apps"])
+        mongo_connection_object.mongo_delete_user_group("unit_test_user_group_2")
+
         # check user_group exists works
         test_reply = mongo_connection_object.mongo_check_user_group_exists("unit_test_user_group")
         self.assertTrue(test_reply)
@@ -447,3 +667,105 @@ class MongoTests(TestCase):
         # check delete user_group works
         test_reply = mongo_connection_object.mongo_delete_user_group("unit_test_user_group")
         self.assertEqual(test_reply.deleted_count, 1)
+
+    def test_mongo_reports_query_planning(self):
+        # check each filters combination is hinted to the most selective index covering it
+        self.assertEqual(get_reports_index_hint({"hostname": "test", "device_group": "test"}), "reports_hostname_index")
+        self.assertEqual(get_reports_index_hint({"device_group": "test", "updated": {"$gte": 1}}),
+                         "reports_device_group_updated_index")
+        self.assertEqual(get_reports_index_hint({"device_group": "test"}), "reports_device_group_index")
+        self.assertEqual(get_reports_index_hint({"report_creation_time": {"$gte": 1}}), "reports_creation_time_index")
+        self.assertEqual(get_reports_index_hint({}), "_id_")
+
+        # check queries served by an index that doesn't exist aren't hinted
+        self.assertIsNone(get_reports_index_hint({"hostname": "test"}, {"reports_device_group_index"}))
+        self.assertEqual(get_reports_index_hint({"device_group": "test"}, {"reports_device_group_index"}),
+                         "reports_device_group_index")
+        self.assertEqual(get_reports_index_hint({}, set()), "_id_")
+
+        # check the explain summary walks the winning plan stages
+        test_reply = get_explain_summary({
+            "queryPlanner": {
+                "winningPlan": {
+                    "stage": "LIMIT",
+                    "inputStage": {
+                        "stage": "FETCH",
+                        "inputStage": {"stage": "IXSCAN", "indexName": "reports_hostname_index"}
+                    }
+                }
+            },
+            "executionStats": {"totalKeysExamined": 10, "totalDocsExamined": 10, "nReturned": 10,
+                               "executionTimeMillis": 1}
+        })
+        self.assertEqual(test_reply["stages"], ["LIMIT", "FETCH", "IXSCAN"])
+        self.assertEqual(test_reply["indexes"], ["reports_hostname_index"])
+        self.assertEqual(test_reply["docs_examined"], 10)
+
+    def test_mongo_latest_reports_flow(self):
+        mongo_connection_object = mongo_connection()
+
+        # ensure no test latest report is already stored in the unit test DB
+        mongo_connection_object.collection["reports_latest"].delete_many({"_id": {"$in": ["unit_test_host_1",
+                                                                                         "unit_test_host_2"]}})
+
+        # check only the newest report of each hostname is kept no matter the order the reports are applied in
+        mongo_connection_object.mongo_upsert_latest_reports([
+            {"_id": ObjectId(), "hostname": "unit_test_host_1", "device_group": "unit_test_dg",
+             "report_creation_time": 2},
+            {"_id": ObjectId(), "hostname": "unit_test_host_1", "device_group": "unit_test_dg",
+             "report_creation_time": 1},
+            {"_id": ObjectId(), "hostname": "unit_test_host_2", "device_group": "unit_test_dg_2",
+             "report_creation_time": 1},
+            {"_id": ObjectId(), "device_group": "unit_test_dg", "report_creation_time": 3}
+        ])
+        test_reply = mongo_connection_object.mongo_list_latest_reports("unit_test_dg")
+        self.assertEqual([latest_report["_id"] for latest_report in test_reply], ["unit_test_host_1"])
+        self.assertEqual(test_reply[0]["report_creation_time"], 2)
+
+        # check a newer report replaces the latest report & moves the hostname to its device group
+        mongo_connection_object.mongo_upsert_latest_reports([
+            {"_id": ObjectId(), "hostname": "unit_test_host_1", "device_group": "unit_test_dg_2",
+             "report_creation_time": 3}
+        ])
+        test_reply = mongo_connection_object.mongo_list_latest_reports("unit_test_dg_2")
+        self.assertEqual([latest_report["_id"] for latest_report in test_reply],
+                         ["unit_test_host_1", "unit_test_host_2"])
+        self.assertEqual(mongo_connection_object.mongo_list_latest_reports("unit_test_dg"), [])
+
+        # check a report inserted after the checkpoint passed its _id is still applied within the overlap time
+        mongo_connection_object.collection["reports_latest"].delete_many({"_id": "unit_test_host_3"})
+        mongo_connection_object.mongo_set_latest_reports_checkpoint(ObjectId())
+        test_report_id = ObjectId.from_datetime(datetime.datetime.utcnow() - datetime.timedelta(seconds=60))
+        mongo_connection_object.collection["reports"].insert_one({"_id": test_report_id, "hostname": "unit_test_host_3",
+                                                                  "device_group": "unit_test_dg_3",
+                                                                  "report_creation_time": 1})
+        mongo_connection_object.mongo_update_latest_reports(overlap_time=300)
+        test_reply = mongo_connection_object.mongo_list_latest_reports("unit_test_dg_3")
+        self.assertEqual([latest_report["report_id"] for latest_report in test_reply], [test_report_id])
+
+        # check the reports before the checkpoint are only rescanned once per overlap time
+        test_late_report_id = ObjectId.from_datetime(datetime.datetime.utcnow() - datetime.timedelta(seconds=30))
+        mongo_connection_object.collection["reports"].insert_one({"_id": test_late_report_id,
+                                                                  "hostname": "unit_test_host_3",
+                                                                  "device_group": "unit_test_dg_3",
+                                                                  "report_creation_time": 2})
+        mongo_connection_object.mongo_update_latest_reports(overlap_time=300)
+        test_reply = mongo_connection_object.mongo_list_latest_reports("unit_test_dg_3")
+        self.assertEqual([latest_report["report_id"] for latest_report in test_reply], [test_report_id])
+        mongo_connection_object.collection["settings"].update_one({"_id": "reports_latest_checkpoint"},
+                                                                  {"$unset": {"overlap_scanned_at": ""}})
+        mongo_connection_object.mongo_update_latest_reports(overlap_time=300)
+        test_reply = mongo_connection_object.mongo_list_latest_reports("unit_test_dg_3")
+        self.assertEqual([latest_report["report_id"] for latest_report in test_reply], [test_late_report_id])
+        mongo_connection_object.collection["reports"].delete_many({"_id": {"$in": [test_report_id,
+                                                                                   test_late_report_id]}})
+
+        # check only the newest report of each hostname in a batch is upserted
+        mongo_connection_object.mongo_upsert_latest_reports([
+            {"_id": ObjectId(), "hostname": "unit_test_host_4", "device_group": "unit_test_dg_4",
+             "report_creation_time": 2},
+            {"_id": ObjectId(), "hostname": "unit_test_host_4", "device_group": "unit_test_dg_4",
+             "report_creation_time": 1}
+        ])
+        test_reply = mongo_connection_object.mongo_list_latest_reports("unit_test_dg_4")
+        self.assertEqual(test_reply[0]["report_creation_time"], 2)
@@ -15,3 +15,82 @@ class HashTests(TestCase):
         test_hash = hash_secret("test")
         secret_matches = check_secret_matches("a_wrong_value", test_hash)
         self.assertFalse(secret_matches)
+
+    def test_generate_token_has_token_id(self):
+        # check generated tokens have a token_id & that it's part of the token
+        test_token = generate_token()
+        test_token_id = get_token_id(test_token)
+        self.assertEqual(len(test_token_id), 16)
+        self.assertTrue(test_token.startswith(test_token_id + "."))
+
+    def test_get_token_id_legacy_token(self):
+        # check legacy tokens are returned as not having a token_id
+        test_token_id = get_token_id("an_old_style_token_without_a_token_id")
+        self.assertIsNone(test_token_id)
+
+    def test_verified_secrets_cache_flow(self):
+        test_cache = VerifiedSecretsCache()
+
+        # check unverified secrets are not returned as verified
+        self.assertIsNone(test_cache.get_verified_user("password", "test", login_name="test_user"))
+
+        # check verified secrets are returned only for the login they were verified with
+        test_cache.add_verified_secret("password", "test", "test_user", login_name="test_user")
+        test_cache.add_verified_secret("token", "test_token", "test_user")
+        self.assertEqual(test_cache.get_verified_user("password", "test", login_name="test_user"), "test_user")
+        self.assertIsNone(test_cache.get_verified_user("password", "test", login_name="other_user"))
+        self.assertIsNone(test_cache.get_verified_user("password", "wrong", login_name="test_user"))
+        self.assertEqual(test_cache.get_verified_user("token", "test_token"), "test_user")
+
+        # check invalidating a user removes all of its verified secrets
+        test_cache.invalidate_user("test_user")
+        self.assertIsNone(test_cache.get_verified_user("password", "test", login_name="test_user"))
+        self.assertIsNone(test_cache.get_verified_user("token", "test_token"))
+
+        # check secrets verified at another permissions version are not returned as verified
+        test_cache.add_verified_secret("token", "test_token", "test_user", permissions_version=1)
+        self.assertEqual(test_cache.get_verified_user("token", "test_token", permissions_version=1), "test_user")
+        self.assertIsNone(test_cache.get_verified_user("token", "test_token", permissions_version=2))
+        self.assertIsNone(test_cache.get_verified_user("token", "test_token", permissions_version=1))
+
+    def test_hashing_pool_flow(self):
+        test_pool = HashingPool(pool_size=1, max_queue_size=1)
+
+        # check hashing & checking on the pool works
+        test_hash = test_pool.hash_secret("test")
+        self.assertTrue(test_pool.check_secret_matches("test", test_hash))
+        self.assertFalse(test_pool.check_secret_matches("a_wrong_value", test_hash))
+
+        # check the pool counters are updated
+        test_stats = test_pool.get_stats()
+        self.assertEqual(test_stats["completed_tasks"], 3)
+        self.assertEqual(test_stats["pending_tasks"], 0)
+        self.assertEqual(test_stats["rejected_tasks"], 0)
+        self.assertGreaterEqual(test_stats["queue_wait_time_max"], 0)
+
+    def test_hashing_pool_queue_full(self):
+        # check tasks are rejected when the queue is full
+        test_pool = HashingPool(pool_size=1, max_queue_size=0)
+        test_pool.pending_tasks = 1
+        with self.assertRaises(HashingQueueFull):
+            test_pool.hash_secret("test")
+        self.assertEqual(test_pool.get_stats()["rejected_tasks"], 1)
+
+    def test_session_token_flow(self):
+        test_key = b"unit_test_session_key"
+
+        # check a session token created with the key is read back
+        test_token = create_session_token(test_key, "test_user", 3, 60)
+        self.assertTrue(test_token.startswith(SESSION_TOKEN_PREFIX))
+        test_session = read_session_token(test_key, test_token)
+        self.assertEqual(test_session["user_name"], "test_user")
+        self.assertEqual(test_session["permissions_version"], 3)
+
+        # check session tokens signed with a different key or changed are rejected
+        self.assertIsNone(read_session_token(b"another_session_key", test_token))
+        self.assertIsNone(read_session_token(test_key, test_token[:-1]))
+        self.assertIsNone(read_session_token(test_key, SESSION_TOKEN_PREFIX + "not_a_session"))
+
+        # check expired session tokens are rejected
+        test_token = create_session_token(test_key, "test_user", 3, -1)
+        self.assertIsNone(read_session_token(test_key, test_token))
@@ -0,0 +1,37 @@
+from unittest import TestCase
+from functions.notifications.notifications import *
+
+
+class NotificationsTests(TestCase):
+
+    def test_change_notifier_notify_key(self):
+        test_notifier = ChangeNotifier()
+
+        # check all listeners of a key are woken by a change on it & listeners of other keys are not
+        with test_notifier.listen("test_key") as test_event_1, test_notifier.listen("test_key") as test_event_2, \
+                test_notifier.listen("other_key") as test_other_event:
+            self.assertEqual(test_notifier.count_listeners("test_key"), 2)
+            test_notifier.notify("test_key")
+            self.assertTrue(test_event_1.is_set())
+            self.assertTrue(test_event_2.is_set())
+            self.assertFalse(test_other_event.is_set())
+
+        # check listeners are removed once they stop listening
+        self.assertEqual(test_notifier.count_listeners("test_key"), 0)
+        self.assertEqual(test_notifier.listeners, {})
+
+    def test_change_notifier_notify_all(self):
+        test_notifier = ChangeNotifier()
+
+        # check a change announced on no key wakes the listeners of all keys
+        with test_notifier.listen("test_key") as test_event, test_notifier.listen("other_key") as test_other_event:
+            test_notifier.notify(None)
+            self.assertTrue(test_event.is_set())
+            self.assertTrue(test_other_event.is_set())
+
+    def test_change_notifier_wait_timeout(self):
+        test_notifier = ChangeNotifier()
+
+        # check waiting for a change that doesn't happen times out
+        with test_notifier.listen("test_key") as test_event:
+            self.assertFalse(test_event.wait(0.01))
@@ -0,0 +1,81 @@
+from unittest import TestCase
+from functions.rollouts.rollouts import *
+
+
+def create_temp_app_rollout(started_at, batch_percent, interval):
+    app_rollout = {
+        "_id": "unit_test_app",
+        "batch_percent": batch_percent,
+        "interval": interval,
+        "current_app": {"app_name": "unit_test_app", "app_id": 2},
+        "previous_app": {"app_name": "unit_test_app", "app_id": 1},
+        "started_at": started_at,
+        "finishes_at": get_rollout_finish_time(started_at, batch_percent, interval)
+    }
+    return app_rollout
+
+
+class RolloutsTests(TestCase):
+
+    def test_rollout_waves(self):
+        test_app_rollout = create_temp_app_rollout(1000, 30, 60)
+
+        # check each interval gives another batch of the devices the new version until all of them have it
+        self.assertEqual(test_app_rollout["finishes_at"], 1180)
+        self.assertEqual(get_rollout_wave_percent(test_app_rollout, 1000), 30)
+        self.assertEqual(get_rollout_wave_percent(test_app_rollout, 1059), 30)
+        self.assertEqual(get_rollout_wave_percent(test_app_rollout, 1060), 60)
+        self.assertEqual(get_rollout_wave_percent(test_app_rollout, 1179), 90)
+        self.assertEqual(get_rollout_wave_percent(test_app_rollout, 1180), 100)
+
+        # check a device stays in the wave once it's in it & all the devices are in it once the rollout finishes
+        test_device_bucket = get_rollout_bucket("unit_test_app", "unit_test_device")
+        self.assertEqual(test_device_bucket, get_rollout_bucket("unit_test_app", "unit_test_device"))
+        test_in_wave = [is_device_in_rollout_wave(test_app_rollout, "unit_test_device", test_time)
+                        for test_time in [1000, 1060, 1120, 1180]]
+        self.assertEqual(test_in_wave, sorted(test_in_wave))
+        self.assertTrue(test_in_wave[-1])
+
+        # check the devices are spread across the waves
+        test_devices_in_first_wave = [is_device_in_rollout_wave(test_app_rollout, "unit_test_device_" + str(number),
+                                                                1000) for number in range(1000)]
+        self.assertTrue(200 < test_devices_in_first_wave.count(True) < 400)
+
+    def test_apply_held_back_apps(self):
+        test_config = {"apps": [{"app_name": "unit_test_app", "app_id": 2}, {"app_name": "other_app", "app_id": 5}],
+                       "device_group_id": 1}
+        test_versions = {"device_group_id": 1, "prune_id": 1, "apps": {"unit_test_app": 2, "other_app": 5},
+                         "cron_jobs": {}}
+
+        # check only the held back apps are replaced with their previous version & the originals are unchanged
+        test_held_back_config, test_held_back_versions = apply_held_back_apps(
+            test_config, test_versions, {"unit_test_app": {"app_name": "unit_test_app", "app_id": 1}})
+        self.assertEqual(test_held_back_config["apps"], [{"app_name": "unit_test_app", "app_id": 1},
+                                                         {"app_name": "other_app", "app_id": 5}])
+        self.assertEqual(test_held_back_versions["apps"], {"unit_test_app": 1, "other_app": 5})
+        self.assertEqual(test_versions["apps"], {"unit_test_app": 2, "other_app": 5})
+        self.assertEqual(test_config["apps"][0]["app_id"], 2)
+
+        # check the config digest changes with the content of the apps held back
+        test_versions["config_digest"] = "unit_test_digest"
+        ignored, test_held_back_versions = apply_held_back_apps(
+            test_config, test_versions, {"unit_test_app": {"app_name": "unit_test_app", "app_id": 1}})
+        ignored, test_other_held_back_versions = apply_held_back_apps(
+            test_config, test_versions, {"unit_test_app": {"app_name": "unit_test_app", "app_id": 1, "running": False}})
+        self.assertNotEqual(test_held_back_versions["config_digest"], "unit_test_digest")
+        self.assertNotEqual(test_held_back_versions["config_digest"], test_other_held_back_versions["config_digest"])
+        ignored, test_held_back_versions = apply_held_back_apps(test_config, test_versions, {})
+        self.assertEqual(test_held_back_versions["config_digest"], "unit_test_digest")
+
+    def test_get_rollout_progress(self):
+        test_app_rollout = create_temp_app_rollout(1000, 50, 60)
+
+        # check the progress of a rollout is reported
+        test_reply = get_rollout_progress(test_app_rollout, 1000)
+        self.assertEqual(test_reply["app_id"], 2)
+        self.assertEqual(test_reply["previous_app_id"], 1)
+        self.assertEqual(test_reply["rolled_out_percent"], 50)
+        self.assertFalse(test_reply["finished"])
+        test_reply = get_rollout_progress(test_app_rollout, 1060)
+        self.assertEqual(test_reply["rolled_out_percent"], 100)
+        self.assertTrue(test_reply["finished"])